@@ -1,10 +1,10 @@
 import abc
 import numpy as np
-import random
-from communication import Communication, MapUpdatePayload, EnergyAndSeedLevelsStatusPayload, DroneLocationPayload, \
+from communication import Communication, EnergyAndSeedLevelsStatusPayload, DroneLocationPayload, \
     MapUpdateMessage, EnergyAndSeedLevelsStatusMessage, DroneLocationMessage, ChargingStatusMessage, \
-    DronePlantingMessage, ChargingStatusPayload
-from grid import Map, Position
+    DronePlantingMessage, ChargingStatusPayload, MessageBatch
+from config import Config
+from grid import Map, Position, create_unknown_map
 from strategy import CooperativeCharging
 
 
@@ -105,11 +105,13 @@ class CommunicativeObservation(Observation):
 class Agent(abc.ABC):
     """Base class for all agents."""
 
-    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map) -> None:
+    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map,
+                 config: Config = None, rng: np.random.Generator = None, known_map: Map = None) -> None:
         self.last_observation = None
+        self.config = config if config is not None else Config()
         self._agent_id = agent_id
-        self.rng = np.random.default_rng()
-        self.drone = self.create_drone(agent_id, max_number_of_seeds, max_battery_available, map)
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.drone = self.create_drone(agent_id, max_number_of_seeds, max_battery_available, map, known_map)
 
     @abc.abstractmethod
     def see(self, map: Map) -> None:
@@ -126,17 +128,21 @@ class Agent(abc.ABC):
         """Resets the agent to its initial state."""
         pass
 
-    def create_drone(self, id: int, max_number_of_seeds: int, max_battery_available: int, map: Map):
+    def create_drone(self, id: int, max_number_of_seeds: int, max_battery_available: int, map: Map,
+                     known_map: Map = None):
         from drone import Drone
+        from metrics import RunningStatistic
         """Creates a drone in a random location.
-        The drone initial location may overlap with another drone."""
+        The drone initial location may overlap with another drone. The drone knows the given map, e.g. the
+        blackboard map shared by a fleet, or by default a map of its own of the size of the environment map."""
 
-        possible_drone_locations = [location for location in map.possible_drone_positions]
-        location = self.rng.choice(possible_drone_locations)
-        drone = Drone(loc=location, id=id, max_number_of_seeds=max_number_of_seeds,
+        drone = Drone(loc=map.random_drone_position(self.rng), id=id, max_number_of_seeds=max_number_of_seeds,
                       max_battery_available=max_battery_available, distance_between_fertile_lands=0,
-                      distance_needed_to_identify_fertile_land=list(), energy_per_planted_tree=list(),
-                      charging_station_loc=map.find_charging_station())
+                      distance_needed_to_identify_fertile_land=RunningStatistic(self.config.histogram_bins),
+                      energy_per_planted_tree=RunningStatistic(self.config.histogram_bins),
+                      charging_station_loc=map.find_charging_station(),
+                      map=known_map if known_map is not None else create_unknown_map(map.height, map.width),
+                      config=self.config)
 
         return drone
 
@@ -152,8 +158,9 @@ class Agent(abc.ABC):
 class RandomAgent(Agent):
     """Baseline agent that randomly chooses an action at each timestep."""
 
-    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map) -> None:
-        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map)
+    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map,
+                 config: Config = None, rng: np.random.Generator = None, known_map: Map = None) -> None:
+        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map, config, rng, known_map)
 
     def see(self, map: Map) -> None:
         """Observes the current state of the environment through its sensors."""
@@ -170,36 +177,29 @@ class RandomAgent(Agent):
                                        self.drone.map)
 
 
-def has_enough_energy(drone, target):
+def has_enough_energy(drone, target, target_cost: int = None):
     """
     Checks that there is enough energy to go to nearest plantable square and head back to charging station,
     considering the drone's current position, the target and the target's distance to the charging station.
+    The size of the path to the target can be given when it is already known.
 
     """
-    target_cost = len(breadth_first_search(drone.get_loc(), target))
-    battery_cost = target_cost + len(breadth_first_search(target, drone.get_charging_station()))
+    if target_cost is None:
+        path = drone.get_path_finder().shortest_path(drone.get_map(), drone.get_loc(), target)
+        if path is None:
+            return False
+        target_cost = len(path)
+    battery_cost = target_cost + path_size_to_charging_station(drone, target)
 
     return drone.get_battery_available() > battery_cost
 
 
-def breadth_first_search(source: Position, target: Position) -> list[Position]:
-    """Computes the list of positions in the path from source to target.
-    It uses a BFS so the path is the shortest path."""
-
-    queue = [(source, (source,))]
-
-    visited = set()
-    while len(queue) > 0:
-        curr, curr_path = queue.pop(0)
-
-        if curr == target:
-            return list(curr_path)
-
-        for neighbour in curr.adj:
-            if neighbour not in visited:
-                neighbour_path = curr_path + (neighbour,)
-                queue.append((neighbour, neighbour_path))
-                visited.add(neighbour)
+def path_size_to_charging_station(drone, p: Position) -> int:
+    """
+    Returns the number of positions in the shortest path from p to the charging station, both included,
+    looked up in the distance field of the charging station.
+    """
+    return drone.get_path_finder().distance(drone.get_map(), p, drone.get_charging_station()) + 1
 
 
 def move_in_path_and_act(agent_drone, path: list[Position], goal):
@@ -238,39 +238,125 @@ def move_in_path_and_act(agent_drone, path: list[Position], goal):
 
 def go_to_charging_station(drone):
     """Returns the action to take to go to the charging station."""
-    from drone import Goal
+    from drone import Action, Goal
 
-    shortest_path = breadth_first_search(drone.get_loc(), drone.get_charging_station())
-    action = move_in_path_and_act(drone, shortest_path, Goal.CHARGE)
+    location = drone.get_loc()
+    if location == drone.get_charging_station():
+        next_path = [location]
+    else:
+        next_position = drone.get_path_finder().next_position(drone.get_map(), location, drone.get_charging_station())
+        if next_position == location:
+            # The charging station cannot be reached.
+            return Action.STAY
+        next_path = [location, next_position]
+    action = move_in_path_and_act(drone, next_path, Goal.CHARGE)
 
     return action
 
 
+class Plan:
+    """Path to the nearest square that a drone commits to and follows until it is invalidated. The path is kept
+    whole, with the index of the drone's position in it, so following it does not copy it."""
+
+    def __init__(self, path: list[Position], exploring: bool, map: Map):
+        self.path = path
+        self.index = 0
+        self.exploring = exploring
+        self.fertile_land_version = map.fertile_land_version
+        self.obstacles_version = map.obstacles_version
+
+    def get_path(self) -> list[Position]:
+        """Returns the remaining path, starting at the drone's location."""
+        return self.path[self.index:]
+
+    def get_next_step(self) -> list[Position]:
+        """Returns the first two positions of the remaining path, only the target once the drone reached it."""
+        return self.path[self.index:self.index + 2]
+
+    def get_length(self) -> int:
+        """Returns the number of positions of the remaining path."""
+        return len(self.path) - self.index
+
+    def get_target(self) -> Position:
+        """Returns the square at the end of the path."""
+        return self.path[-1]
+
+    def advance(self, location: Position) -> bool:
+        """Moves past the first position of the remaining path if the drone moved to the next one.
+        Returns False if the drone left the path."""
+        if self.path[self.index] == location:
+            return True
+        if self.index + 1 < len(self.path) and self.path[self.index + 1] == location:
+            self.index += 1
+            return True
+        return False
+
+    def is_valid(self, map: Map) -> bool:
+        """Returns True if the target is still the one the drone should go to, False otherwise."""
+        if self.obstacles_version != map.obstacles_version:
+            return False
+        target = self.get_target()
+        if self.exploring:
+            # Known plantable squares take priority over exploring.
+            return map.is_unknown(target) and map.number_of_plantable_squares() == 0
+        if not map.is_fertile_land(target):
+            return False
+        if self.fertile_land_version != map.fertile_land_version:
+            # Only the plantable squares found since the plan can be closer than its target, and since a path is
+            # never shorter than the Chebyshev distance, only those within a smaller distance than the target.
+            added_fertile_land = map.get_fertile_land_added_since(self.fertile_land_version)
+            if added_fertile_land is None:
+                return False
+            location = self.path[self.index]
+            for index in added_fertile_land:
+                square = map.position_at(index)
+                if max(abs(square.x - location.x), abs(square.y - location.y)) < self.get_length() - 1 \
+                        and map.is_fertile_land(square):
+                    return False
+            self.fertile_land_version = map.fertile_land_version
+        return True
+
+
+def plan_nearest_square(drone) -> Plan | None:
+    """Returns a plan to go to the nearest plantable square, or to the nearest unvisited cell when no plantable
+    square is known. Returns None if there is no such square."""
+    drone_map = drone.get_map()
+    path_finder = drone.get_path_finder()
+
+    exploring = drone_map.number_of_plantable_squares() == 0
+    if exploring:
+        shortest_path = path_finder.nearest_path(drone_map, drone.get_loc(), drone_map.unknown_mask())
+    else:
+        shortest_path = path_finder.nearest_path(drone_map, drone.get_loc(), drone_map.fertile_land_mask())
+
+    if shortest_path is None:
+        return None
+    return Plan(shortest_path, exploring, drone_map)
+
+
 def plant_nearest_square(drone):
     """Returns the action to take to plant the nearest square."""
     from drone import Action, Goal
 
-    plantable_squares = drone.get_map().plantable_squares()
-    unvisited_cells = drone.get_map().get_unknown_cells()
-
-    if len(plantable_squares) == 0:
-        # Sample the unvisited cells for performance reasons.
-        size = int(0.1 * len(unvisited_cells))
-        if size > 0 and len(unvisited_cells) > 10:
-            unvisited_cells = random.sample(unvisited_cells, size)
-        shortest_paths = [breadth_first_search(drone.get_loc(), p) for p in unvisited_cells]
-        shortest_path_id = np.argmin([len(p) for p in shortest_paths])
-        go_plant_or_move_flag = has_enough_energy(drone, unvisited_cells[shortest_path_id])
-    else:
-        shortest_paths = [breadth_first_search(drone.get_loc(), p) for p in plantable_squares]
-        shortest_path_id = np.argmin([len(p) for p in shortest_paths])
-        go_plant_or_move_flag = has_enough_energy(drone, plantable_squares[shortest_path_id])
+    # Follows the committed plan unless it was invalidated, otherwise plans again.
+    plan = drone.get_plan()
+    if plan is None or not plan.advance(drone.get_loc()) or not plan.is_valid(drone.get_map()):
+        plan = plan_nearest_square(drone)
+        drone.set_plan(plan)
+
+    if plan is None:
+        return go_to_charging_station(drone)
+
+    target = plan.get_target()
+    path_length = plan.get_length()
+
+    go_plant_or_move_flag = has_enough_energy(drone, target, path_length)
 
     if go_plant_or_move_flag:
-        if len(shortest_paths[shortest_path_id]) == 1 and drone.get_loc() == shortest_paths[shortest_path_id][0]:
+        if path_length == 1 and drone.get_loc() == target:
             return Action.PLANT
         else:
-            action = move_in_path_and_act(drone, shortest_paths[shortest_path_id], Goal.PLANT)
+            action = move_in_path_and_act(drone, plan.get_next_step(), Goal.PLANT)
             return action
     else:
         return go_to_charging_station(drone)
@@ -279,25 +365,24 @@ def plant_nearest_square(drone):
 class GreedyAgent(Agent):
     """Agent that plans its path using a BFS."""
 
-    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map) -> None:
-        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map)
+    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map,
+                 config: Config = None, rng: np.random.Generator = None, known_map: Map = None) -> None:
+        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map, config, rng, known_map)
 
     def see(self, map: Map) -> None:
         self.last_observation = GreedyObservation(map, self.drone)
         self.drone.update_map_greedy(self.last_observation)
-        self.drone.get_map().update_planted_squares()
 
     def choose_action(self):
         from drone import Action
 
         location = self.drone.get_loc()
-        charging_station = self.drone.get_charging_station()
 
         # No seeds
-        if self.drone.get_nr_seeds().count(0) >= 1:
+        if 0 in self.drone.get_nr_seeds():
             return go_to_charging_station(self.drone)
 
-        path_size_to_cs = len(breadth_first_search(location, charging_station))
+        path_size_to_cs = path_size_to_charging_station(self.drone, location)
 
         if path_size_to_cs == 0:
             return Action.CHARGE
@@ -315,8 +400,9 @@ class GreedyAgent(Agent):
 class CommunicativeAgent(Agent):
     """Agent that communicates with other agents."""
 
-    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map) -> None:
-        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map)
+    def __init__(self, agent_id: int, max_number_of_seeds: int, max_battery_available: int, map: Map,
+                 config: Config = None, rng: np.random.Generator = None, known_map: Map = None) -> None:
+        super().__init__(agent_id, max_number_of_seeds, max_battery_available, map, config, rng, known_map)
         self.communication = None
         self.energy_level_and_seed_status = {}
         self.charging_status = {}
@@ -336,13 +422,23 @@ class CommunicativeAgent(Agent):
     def see(self, map: Map) -> None:
         self.last_observation = CommunicativeObservation(map, self.drone)
         self.drone.update_map_coomunicative(self.last_observation)
-        self.drone.get_map().update_planted_squares()
         self.send_sensors_messages(self.last_observation)
 
     def receive_message(self, message):
         """Receives a message."""
         self.handle_new_message(message)
 
+    def receive_batch(self, batch: MessageBatch) -> None:
+        """Receives the messages of all the agents at once. The map updates of the whole batch are applied together,
+        the own observations of the agent being already in its map."""
+        for bundle in batch.get_bundles():
+            if bundle.get_sender() == self._agent_id:
+                continue
+            for message in bundle.get_messages():
+                if not isinstance(message, MapUpdateMessage):
+                    self.handle_new_message(message)
+        self.drone.get_map().update_cells(*batch.get_map_update())
+
     def handle_new_message(self, message):
         """Handles a new message."""
         if isinstance(message, MapUpdateMessage):
@@ -361,15 +457,7 @@ class CommunicativeAgent(Agent):
     def update_map(self, message: MapUpdateMessage) -> None:
         """Updates drone's map."""
         payload = message.get_payload()
-        adj_positions = payload.get_adj_positions()
-        adj_cell_types = payload.get_adj_cell_types()
-        location = payload.get_current_location()
-        location_cell_type = payload.get_current_cell_type()
-
-        for i in range(len(adj_positions)):
-            self.drone.get_map().update_position(adj_positions[i], adj_cell_types[i])
-        self.drone.get_map().update_position(location, location_cell_type)
-        self.drone.get_map().update_planted_squares()
+        self.drone.get_map().update_cells(payload.get_indices(), payload.get_codes())
 
     def update_energy_and_seed_level_status(self, message: EnergyAndSeedLevelsStatusMessage) -> None:
         """Updates drone's energy and seed level."""
@@ -412,13 +500,12 @@ class CommunicativeAgent(Agent):
         from drone import Action
 
         location = self.drone.get_loc()
-        charging_station = self.drone.get_charging_station()
 
         # No seeds
-        if self.drone.get_nr_seeds().count(0) >= 1:
+        if 0 in self.drone.get_nr_seeds():
             return go_to_charging_station(self.drone)
 
-        path_size_to_cs = len(breadth_first_search(location, charging_station))
+        path_size_to_cs = path_size_to_charging_station(self.drone, location)
 
         if path_size_to_cs == 0:
             return Action.CHARGE
@@ -429,13 +516,30 @@ class CommunicativeAgent(Agent):
             return plant_nearest_square(self.drone)
 
     def reset(self) -> None:
+        # A drone of a blackboard fleet keeps the map shared with the others.
+        known_map = self.drone.get_map() if self.drone.get_map_sharing() == "blackboard" else None
         self.drone = self.create_drone(self._agent_id, self.drone.max_number_of_seeds, self.drone.max_battery_available,
-                                       self.drone.map)
+                                       self.drone.map, known_map)
         self.communication = None
 
     def set_agents(self, agents: list[Agent]) -> None:
-        """Sets the agents of the agent."""
-        self.communication = Communication(self._agent_id, agents)
+        """
+        Sets the agents of the agent. Agents set with the same list share the bus their messages go through and,
+        when the map sharing mode is blackboard, the map of the first of them, unless they were created with it.
+        """
+        peer = None
+        for agent in agents:
+            if agent is not self and isinstance(agent, CommunicativeAgent) and agent.get_communication() is not None \
+                    and agent.get_communication().agents is agents:
+                peer = agent
+                break
+
+        if peer is None:
+            self.communication = Communication(self._agent_id, agents)
+        else:
+            self.communication = Communication(self._agent_id, agents, peer.get_communication().get_bus())
+            if self.drone.get_map_sharing() == "blackboard" and self.drone.get_map() is not peer.get_drone().get_map():
+                self.drone.set_map(peer.get_drone().get_map())
 
     def get_communication(self):
         """Returns the communication of the agent."""
@@ -446,13 +550,15 @@ class CommunicativeAgent(Agent):
         return self.strategies['CooperativeCharging']
 
     def send_sensors_messages(self, observation: CommunicativeObservation) -> None:
-        """Sends the sensors status to the other agents."""
-        adj_locations = observation.get_adj_locations()
-        adj_cell_types = observation.get_adj_cell_types()
-        current_loc = observation.get_current_loc()
-        current_cell_type = observation.get_current_cell_type()
-        payload = MapUpdatePayload(adj_locations, adj_cell_types, current_loc, current_cell_type)
-        self.get_communication().send_map_update(payload)
+        """Sends the sensors status to the other agents. With a blackboard map the observations are already
+        written in the map every agent reads, so no map update is sent."""
+        if self.drone.get_map_sharing() != "blackboard":
+            width = self.drone.get_map().width
+            positions = [*observation.get_adj_locations(), observation.get_current_loc()]
+            cell_types = observation.get_adj_cell_types() + [observation.get_current_cell_type()]
+            indices = np.array([p.y * width + p.x for p in positions], dtype=np.int64)
+            codes = np.array([cell_type.value for cell_type in cell_types], dtype=np.uint8)
+            self.get_communication().send_map_cells(self.drone.get_map().grid.size, indices, codes)
 
         energy = observation.get_current_energy()
         seeds = observation.get_current_seeds()
@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import numpy as np
+from agent import plant_nearest_square
+from communication import deliver_messages
+from config import Config, AGENT_TYPES
+from default import DefaultMap
+from drone import Action
+from env import Environment
+from grid import Cell, Map, Position
+from main import create_run, step_simulation
+from pathfinding import breadth_first_search
+from printer import HeadlessPrinter
+
+# Every action, drawn at random by the benchmark of the environment step.
+ACTIONS = list(Action)
+
+# Largest map the graphical interface can show.
+MAX_GRAPHICAL_MAP_SIZE = 26
+
+
+def measure(operation, repeats: int, min_time: float = 0.1) -> float:
+    """
+    Returns the median over the repeats of the seconds per call of the operation. Each repeat calls it in a loop
+    long enough to be timed reliably, with the number of calls found by doubling it until it takes min_time.
+    """
+    def time_calls(n_calls: int) -> float:
+        start = time.perf_counter()
+        for _ in range(n_calls):
+            operation()
+        return time.perf_counter() - start
+
+    n_calls = 1
+    while time_calls(n_calls) < min_time and n_calls < 2 ** 20:
+        n_calls *= 2
+    return statistics.median(time_calls(n_calls) / n_calls for _ in range(repeats))
+
+
+def make_config(agent_type: str, map_size: int, n_agents: int, seed: int, **overrides) -> Config:
+    """Returns the config of a benchmark workload. Everything is seeded, so two revisions run the same workload."""
+    values = dict(agent_type=agent_type, map_size=map_size, max_battery_capacity=max(35, 2 * map_size),
+                  nr_agents={agent_type: n_agents}, headless=True, seed=seed, map_seed=seed)
+    values.update(overrides)
+    return Config(**values)
+
+
+def make_run(config: Config) -> tuple[np.ndarray, Map, list, list]:
+    """Returns the grid, map, agents and drones of a seeded run of the config."""
+    grid = DefaultMap(config).MAP
+    map, agents, drones = create_run(grid, config, np.random.SeedSequence(config.seed))
+    return grid, map, agents, drones
+
+
+def result(benchmark: str, config: Config, unit: str, seconds: float, **params) -> dict:
+    """Returns the JSON record of a benchmark."""
+    return {
+        "benchmark": benchmark,
+        "agent_type": config.agent_type,
+        "map_size": config.map_size,
+        "n_agents": config.get_num_agents(),
+        **params,
+        "seconds": seconds,
+        "rate": 1 / seconds if seconds > 0 else float("inf"),
+        "unit": unit,
+    }
+
+
+def bench_breadth_first_search(config: Config, repeats: int) -> list[dict]:
+    """Times a BFS between opposite corners of the map."""
+    grid, map, _, _ = make_run(config)
+    source = Position(x=0, y=0)
+    target = Position(x=map.width - 1, y=map.height - 1)
+    seconds = measure(lambda: breadth_first_search(map, source, target), repeats)
+    return [result("breadth_first_search", config, "searches/s", seconds)]
+
+
+def bench_plant_nearest_square(config: Config, repeats: int) -> list[dict]:
+    """Times the planning of a drone that knows the whole map, without the plan it cached from the last call."""
+    grid, map, _, drones = make_run(config)
+    drone = drones[0]
+    drone.set_map(Map(grid))
+
+    def plan():
+        drone.set_plan(None)
+        plant_nearest_square(drone)
+
+    seconds = measure(plan, repeats)
+    return [result("plant_nearest_square", config, "plans/s", seconds)]
+
+
+def bench_map_queries(config: Config, repeats: int) -> list[dict]:
+    """Times Map.plantable_squares and Map.calculate_planted_squares with half of the fertile land planted."""
+    grid, map, _, _ = make_run(config)
+    fertile_land = map.plantable_squares()
+    for p in fertile_land[::2]:
+        map.change_cell_type(p, Cell.OAK_TREE)
+        map.add_planted_square(p, Cell.OAK_TREE)
+
+    return [
+        result("plantable_squares", config, "queries/s", measure(map.plantable_squares, repeats)),
+        result("calculate_planted_squares", config, "queries/s", measure(map.calculate_planted_squares, repeats)),
+    ]
+
+
+def bench_environment_step(config: Config, repeats: int) -> list[dict]:
+    """Times Environment.step with every drone taking random actions, so planting and charging, which go through
+    the cooperative charging of communicative agents, are timed along with moves. The battery never runs out."""
+    config = make_config(config.agent_type, config.map_size, config.get_num_agents(), config.seed,
+                         max_battery_capacity=2 ** 31)
+    _, map, agents, _ = make_run(config)
+    environment = Environment(HeadlessPrinter(), map)
+    rng = np.random.default_rng(config.seed)
+    actions = [[ACTIONS[i] for i in rng.integers(len(ACTIONS), size=len(agents))] for _ in range(64)]
+    step = iter(range(2 ** 62))
+
+    seconds = measure(lambda: environment.step(actions[next(step) % len(actions)], agents), repeats)
+    return [result("environment_step", config, "steps/s", seconds)]
+
+
+def bench_simulation_step(config: Config, repeats: int) -> list[dict]:
+    """Times a whole step of the simulation: the agents observe, communicate and choose their actions, then the
+    environment steps. Runs from a seeded start, with a battery that never runs out, and starts over with the same
+    run whenever it finishes."""
+    config = make_config(config.agent_type, config.map_size, config.get_num_agents(), config.seed,
+                         max_battery_capacity=2 ** 31)
+    grid = DefaultMap(config).MAP
+    run = {}
+
+    def start():
+        map, agents, drones = create_run(grid, config, np.random.SeedSequence(config.seed))
+        run.update(map=map, agents=agents, drones=drones, environment=Environment(HeadlessPrinter(), map))
+
+    def step():
+        terminal, all_drones_dead = step_simulation(run["environment"], run["map"], run["agents"], run["drones"])
+        if terminal or all_drones_dead:
+            start()
+
+    start()
+    seconds = measure(step, repeats)
+    return [result("simulation_step", config, "steps/s", seconds)]
+
+
+def bench_communication(config: Config, repeats: int) -> list[dict]:
+    """Times a step of communication: every communicative agent observes from a random position and publishes,
+    then the messages are delivered."""
+    config = make_config("CommunicativeAgent", config.map_size, config.get_num_agents(), config.seed,
+                         map_sharing=config.map_sharing)
+    _, map, agents, drones = make_run(config)
+    rng = np.random.default_rng(config.seed)
+
+    def communicate():
+        for agent, drone in zip(agents, drones):
+            drone.loc = map.random_drone_position(rng)
+            agent.see(map)
+        deliver_messages(agents)
+
+    seconds = measure(communicate, repeats)
+    return [result("communication", config, "steps/s", seconds, map_sharing=config.map_sharing)]
+
+
+def bench_printer(config: Config, repeats: int) -> list[dict]:
+    """Times EnvironmentPrinter.print with an offscreen SDL driver, with the drones moving to random positions."""
+    if config.map_size > MAX_GRAPHICAL_MAP_SIZE:
+        return []
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    try:
+        import pygame
+        from graphical import EnvironmentPrinter
+    except ImportError:
+        return []
+
+    grid, map, _, drones = make_run(config)
+    rng = np.random.default_rng(config.seed)
+    with EnvironmentPrinter(map.get_initial_grid()) as printer:
+        environment = Environment(printer, map)
+        environment.render(drones)
+
+        def print_frame():
+            for drone in drones:
+                drone.loc = map.random_drone_position(rng)
+            environment.render(drones)
+            pygame.event.pump()
+
+        seconds = measure(print_frame, repeats)
+    return [result("environment_printer", config, "frames/s", seconds)]
+
+
+def bench_episodes(config: Config, n_episodes: int, max_steps: int) -> list[dict]:
+    """
+    Runs seeded headless episodes end to end, each until it finishes or reaches max_steps, and reports the steps
+    and episodes per second.
+    """
+    seed_sequences = np.random.SeedSequence(config.seed).spawn(n_episodes)
+    grid = DefaultMap(config).MAP
+    n_steps = 0
+    start = time.perf_counter()
+    for seed_sequence in seed_sequences:
+        map, agents, drones = create_run(grid, config, seed_sequence)
+        environment = Environment(HeadlessPrinter(), map)
+        for _ in range(max_steps):
+            n_steps += 1
+            terminal, all_drones_dead = step_simulation(environment, map, agents, drones)
+            if terminal or all_drones_dead:
+                break
+    seconds = time.perf_counter() - start
+    return [
+        result("episode_steps", config, "steps/s", seconds / n_steps, max_steps=max_steps),
+        result("episodes", config, "episodes/s", seconds / n_episodes, max_steps=max_steps),
+    ]
+
+
+# Benchmarks of a single component, whether they depend on the fleet size and whether they depend on the agent type.
+# Those that do not depend on the agent type run with GreedyAgent, or with the agent type they are about.
+MICROBENCHMARKS = {
+    "breadth_first_search": (bench_breadth_first_search, False, False),
+    "plant_nearest_square": (bench_plant_nearest_square, False, False),
+    "map_queries": (bench_map_queries, False, False),
+    "environment_step": (bench_environment_step, True, True),
+    "simulation_step": (bench_simulation_step, True, True),
+    "communication": (bench_communication, True, False),
+    "environment_printer": (bench_printer, True, False),
+}
+
+
+def run_benchmarks(map_sizes: list[int], fleet_sizes: list[int], agent_types: list[str], repeats: int,
+                   n_episodes: int, max_steps: int, only: list[str] = None, seed: int = 0) -> list[dict]:
+    """Runs the selected benchmarks across map sizes, fleet sizes and agent types and returns their records."""
+    results = []
+
+    def report(records: list[dict]):
+        for record in records:
+            print(f"{record['benchmark']:<26} {record['agent_type']:<18} size {record['map_size']:>5} "
+                  f"agents {record['n_agents']:>3} {record['rate']:>14.1f} {record['unit']}", flush=True)
+        results.extend(records)
+
+    for name, (benchmark, depends_on_fleet, depends_on_agent_type) in MICROBENCHMARKS.items():
+        if only is not None and name not in only:
+            continue
+        for agent_type in (agent_types if depends_on_agent_type else ["GreedyAgent"]):
+            for map_size in map_sizes:
+                for n_agents in (fleet_sizes if depends_on_fleet else fleet_sizes[:1]):
+                    report(benchmark(make_config(agent_type, map_size, n_agents, seed), repeats))
+
+    if only is None or "episodes" in only:
+        for agent_type in agent_types:
+            for map_size in map_sizes:
+                for n_agents in fleet_sizes:
+                    report(bench_episodes(make_config(agent_type, map_size, n_agents, seed), n_episodes, max_steps))
+    return results
+
+
+def get_revision() -> str | None:
+    """Returns the git revision of the working tree, if there is one."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def record_key(record: dict) -> tuple:
+    """Returns what identifies a benchmark record across revisions: its name and parameters."""
+    return tuple(sorted((key, value) for key, value in record.items() if key not in ("seconds", "rate", "unit")))
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> list[tuple[dict, dict, float]]:
+    """
+    Compares the records of two benchmark files and prints the change of each rate. Returns the records whose rate
+    dropped by more than the threshold, a fraction of the baseline rate, with their baseline and change.
+    """
+    baseline_records = {record_key(record): record for record in baseline["results"]}
+    regressions = []
+    print(f"\nComparison with {baseline.get('revision')} (regression threshold {threshold:.0%})")
+    for record in current["results"]:
+        old = baseline_records.get(record_key(record))
+        if old is None:
+            continue
+        change = record["rate"] / old["rate"] - 1
+        regressed = change < -threshold
+        print(f"{record['benchmark']:<26} {record['agent_type']:<18} size {record['map_size']:>5} "
+              f"agents {record['n_agents']:>3} {change:>+8.1%}{'  REGRESSION' if regressed else ''}")
+        if regressed:
+            regressions.append((record, old, change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the simulation and compares the results with other revisions.")
+    parser.add_argument("--map-sizes", type=int, nargs="+", default=[15, 26, 50], help="Sizes of the maps.")
+    parser.add_argument("--fleet-sizes", type=int, nargs="+", default=[3, 10], help="Numbers of drones.")
+    parser.add_argument("--agent-types", nargs="+", default=list(AGENT_TYPES), choices=AGENT_TYPES,
+                        help="Types of agents of the end to end benchmarks and of the step benchmarks.")
+    parser.add_argument("--only", nargs="+", default=None, choices=list(MICROBENCHMARKS) + ["episodes"],
+                        help="Runs only these benchmarks.")
+    parser.add_argument("--repeats", type=int, default=5, help="Repeats of each microbenchmark, the median is kept.")
+    parser.add_argument("--episodes", type=int, default=3, help="Episodes of each end to end benchmark.")
+    parser.add_argument("--max-steps", type=int, default=1000, help="Maximum number of steps of an episode.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the workloads.")
+    parser.add_argument("--output", default="benchmark.json", help="Path of the JSON file with the results.")
+    parser.add_argument("--compare", default=None, help="JSON file of another revision to compare the results with.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Drop of a rate, as a fraction of the compared one, reported as a regression.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.map_sizes, args.fleet_sizes, args.agent_types, args.repeats, args.episodes,
+                             args.max_steps, args.only, args.seed)
+    current = {
+        "revision": get_revision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "results": results,
+    }
+    with open(args.output, "w") as fp:
+        json.dump(current, fp, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as fp:
+            regressions = compare(json.load(fp), current, args.threshold)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions above the threshold.")
+            sys.exit(1)
@@ -1,5 +1,6 @@
 import numpy as np
 from grid import Position, Cell
+from instrumentation import INSTRUMENTATION
 
 
 class Payload:
@@ -8,29 +9,22 @@ class Payload:
 
 
 class MapUpdatePayload(Payload):
-    """ Payload for updating the map."""
+    """ Payload for updating the map. Carries only the cells whose known value changed since the sender last
+    published them, packed as read only arrays of flat grid indices (y * width + x) and cell codes."""
 
-    def __init__(self, adj_postions: np.array, adj_cell_types: np.array, current_location: Position, current_cell_type: Cell):
-        self.adj_positions = adj_postions
-        self.adj_cell_types = adj_cell_types
-        self.current_location = current_location
-        self.current_cell_type = current_cell_type
+    def __init__(self, indices: np.ndarray, codes: np.ndarray):
+        self.indices = indices
+        self.codes = codes
+        for array in (self.indices, self.codes):
+            array.setflags(write=False)
 
-    def get_current_location(self):
-        """ Returns the current location."""
-        return self.current_location
+    def get_indices(self):
+        """ Returns the flat grid indices of the cells."""
+        return self.indices
 
-    def get_current_cell_type(self):
-        """ Returns the current cell type."""
-        return self.current_cell_type
-
-    def get_adj_positions(self):
-        """ Returns the adjacent positions."""
-        return self.adj_positions
-
-    def get_adj_cell_types(self):
-        """ Returns the adjacent cell types."""
-        return self.adj_cell_types
+    def get_codes(self):
+        """ Returns the cell codes."""
+        return self.codes
 
 
 class EnergyAndSeedLevelsStatusPayload(Payload):
@@ -83,7 +77,7 @@ class DroneLocationPayload(Payload):
 
 
 class Message:
-    """ Base class for all messages."""
+    """ Base class for all messages. The receiver id is None for messages broadcast to all agents."""
 
     def __init__(self, sender_id: int, receiver_id: int, payload: Payload):
         self.sender_id = sender_id
@@ -138,50 +132,153 @@ class DroneLocationMessage(Message):
         super().__init__(sender_id, receiver_id, payload)
 
 
+class MessageBundle:
+    """ Immutable bundle with the messages an agent published during a step."""
+
+    def __init__(self, sender_id: int, messages: list[Message]):
+        self.sender_id = sender_id
+        self.messages = tuple(messages)
+
+    @classmethod
+    def coalesce(cls, sender_id: int, messages: list[Message]) -> "MessageBundle":
+        """ Bundles the messages, keeping every map update but only the latest message of each other type,
+        since those carry the current status of the sender."""
+        latest = {}
+        map_updates = []
+        for message in messages:
+            if isinstance(message, MapUpdateMessage):
+                map_updates.append(message)
+            else:
+                latest[type(message)] = message
+        return cls(sender_id, map_updates + list(latest.values()))
+
+    def get_sender(self) -> int:
+        """ Returns the sender id."""
+        return self.sender_id
+
+    def get_messages(self) -> tuple[Message, ...]:
+        """ Returns the messages."""
+        return self.messages
+
+
+class MessageBatch:
+    """
+    Immutable batch with the bundles published by all the agents since the last delivery, shared by every receiver.
+    The cells of all the map updates are gathered once in read only arrays of flat indices and cell codes.
+    """
+
+    def __init__(self, bundles: list[MessageBundle]):
+        self.bundles = tuple(bundles)
+        map_updates = [message.get_payload() for bundle in self.bundles for message in bundle.get_messages()
+                       if isinstance(message, MapUpdateMessage)]
+        self.map_update = (np.concatenate([payload.get_indices() for payload in map_updates] + [np.empty(0, dtype=np.int64)]),
+                           np.concatenate([payload.get_codes() for payload in map_updates] + [np.empty(0, dtype=np.uint8)]))
+        for array in self.map_update:
+            array.setflags(write=False)
+
+    def get_bundles(self) -> tuple[MessageBundle, ...]:
+        """ Returns the bundles."""
+        return self.bundles
+
+    def get_map_update(self) -> tuple[np.ndarray, np.ndarray]:
+        """ Returns the flat indices and cell codes of all the cells in the map updates."""
+        return self.map_update
+
+
+class MessageBus:
+    """ Outbox shared by a group of agents. Messages are kept until they are delivered, once per phase of a step,
+    as a single batch to every communicative agent."""
+
+    def __init__(self, agents: list):
+        self.agents = agents
+        self.outbox = {}
+        self.n_published = 0
+
+    def get_number_of_published_messages(self) -> int:
+        """ Returns the number of messages published to the bus since it was created."""
+        return self.n_published
+
+    def publish(self, message: Message):
+        """ Adds a message to the outbox of its sender."""
+        self.outbox.setdefault(message.get_sender(), []).append(message)
+        self.n_published += 1
+        if INSTRUMENTATION.enabled:
+            INSTRUMENTATION.count("messages_" + type(message).__name__)
+
+    def deliver(self):
+        """ Delivers the messages published since the last delivery to all the communicative agents."""
+        from agent import CommunicativeAgent
+        if len(self.outbox) == 0:
+            return
+        batch = MessageBatch([MessageBundle.coalesce(sender_id, messages) for sender_id, messages in self.outbox.items()])
+        self.outbox = {}
+        for agent in self.agents:
+            if isinstance(agent, CommunicativeAgent):
+                agent.receive_batch(batch)
+
+
+def get_buses(agents: list) -> list[MessageBus]:
+    """ Returns the distinct buses of the communicative agents."""
+    from agent import CommunicativeAgent
+    buses = []
+    for agent in agents:
+        if isinstance(agent, CommunicativeAgent) and agent.get_communication() is not None:
+            bus = agent.get_communication().get_bus()
+            if not any(bus is other for other in buses):
+                buses.append(bus)
+    return buses
+
+
+def deliver_messages(agents: list):
+    """ Delivers the messages published by the agents since the last delivery."""
+    for bus in get_buses(agents):
+        bus.deliver()
+
+
 class Communication:
 
-    """ Class for communication between agents."""
+    """ Class for communication between agents. Messages are published to a bus shared by the agents and delivered
+    with deliver_messages."""
 
-    def __init__(self, sender_id: int, agents: list):
+    def __init__(self, sender_id: int, agents: list, bus: MessageBus = None):
         self.sender_id = sender_id
         self.agents = agents
+        self.bus = bus if bus is not None else MessageBus(agents)
+        # Cell codes the sender has published so far, flattened, created with the first map update.
+        self.published_codes = None
+
+    def get_bus(self) -> MessageBus:
+        """ Returns the bus the messages are published to."""
+        return self.bus
 
     def send_map_update(self, payload: MapUpdatePayload):
-        from agent import CommunicativeAgent
         """ Sends a map update message to all agents except the sender."""
-        for agent in self.agents:
-            if agent.get_id() != self.sender_id and isinstance(agent, CommunicativeAgent):
-                message = MapUpdateMessage(self.sender_id, agent.get_id(), payload)
-                agent.receive_message(message)
+        self.bus.publish(MapUpdateMessage(self.sender_id, None, payload))
+
+    def send_map_cells(self, grid_size: int, indices: np.ndarray, codes: np.ndarray):
+        """ Sends a map update with the cells whose code differs from the one the sender last published for them,
+        if there is any. Since every agent receives every update, the others already know the rest."""
+        if self.published_codes is None:
+            self.published_codes = np.full(grid_size, Cell.UNKNOWN.value, dtype=np.uint8)
+        changed = self.published_codes[indices] != codes
+        if changed.any():
+            indices = indices[changed]
+            codes = codes[changed]
+            self.published_codes[indices] = codes
+            self.send_map_update(MapUpdatePayload(indices, codes))
 
     def send_energy_and_seed_levels_status(self, payload: EnergyAndSeedLevelsStatusPayload):
-        from agent import CommunicativeAgent
         """ Sends an energy and seed levels status message to all agents except the sender."""
-        for agent in self.agents:
-            if agent.get_id() != self.sender_id and isinstance(agent, CommunicativeAgent):
-                message = EnergyAndSeedLevelsStatusMessage(self.sender_id, agent.get_id(), payload)
-                agent.receive_message(message)
+        self.bus.publish(EnergyAndSeedLevelsStatusMessage(self.sender_id, None, payload))
 
     def send_drone_location(self, payload: DroneLocationPayload):
-        from agent import CommunicativeAgent
         """ Sends a drone location message to all agents except the sender."""
-        for agent in self.agents:
-            if agent.get_id() != self.sender_id and isinstance(agent, CommunicativeAgent):
-                message = DroneLocationMessage(self.sender_id, agent.get_id(), payload)
-                agent.receive_message(message)
+        self.bus.publish(DroneLocationMessage(self.sender_id, None, payload))
 
     def send_charging_status(self, payload: ChargingStatusPayload):
-        from agent import CommunicativeAgent
         """ Sends a charging status message to all agents except the sender."""
-        for agent in self.agents:
-            if agent.get_id() != self.sender_id and isinstance(agent, CommunicativeAgent):
-                message = ChargingStatusMessage(self.sender_id, agent.get_id(), payload)
-                agent.receive_message(message)
+        self.bus.publish(ChargingStatusMessage(self.sender_id, None, payload))
 
     def send_drone_planting(self, payload: DronePlantingPayload):
-        from agent import CommunicativeAgent
         """ Sends a drone planting message to all agents except the sender."""
-        for agent in self.agents:
-            if agent.get_id() != self.sender_id and isinstance(agent, CommunicativeAgent):
-                message = DronePlantingMessage(self.sender_id, agent.get_id(), payload)
-                agent.receive_message(message)
+        self.bus.publish(DronePlantingMessage(self.sender_id, None, payload))
@@ -0,0 +1,120 @@
+import dataclasses
+import yaml
+from pathfinding import PATH_FINDERS
+
+# Types of agents that can be simulated.
+AGENT_TYPES = ("RandomAgent", "GreedyAgent", "CommunicativeAgent")
+
+# Types of agents with a batched policy, that the vectorized environment can step in batches.
+BATCHED_AGENT_TYPES = ("RandomAgent", "GreedyAgent")
+
+# How communicative drones share what they know about the map. With private maps every drone keeps its own map and
+# receives the observations of the others in messages, with a blackboard all the drones read and write the same map.
+MAP_SHARING_MODES = ("private", "blackboard")
+
+
+@dataclasses.dataclass(frozen=True)
+class Config:
+    """
+    Parameters of the simulation. Loaded once, validated, and passed to the map generation, the agents and their
+    drones, instead of each of them reading config.yml. The defaults are the values of the config file in the repo.
+    """
+
+    n_runs: int = 100
+    agent_type: str = "CommunicativeAgent"
+    map_size: int = 15
+    max_number_of_seeds: int = 5
+    max_battery_capacity: int = 35
+    nr_charging_stations: int = 1
+    fertile_land_ratio: float = 0.7
+    nr_agents: dict = dataclasses.field(
+        default_factory=lambda: {"RandomAgent": 6, "GreedyAgent": 5, "CommunicativeAgent": 2})
+    timestep: float = 0
+    headless: bool = False
+    n_workers: int = 1
+    path_finding: str = "chebyshev"
+    map_sharing: str = "private"
+    batch_size: int = 0
+    seed: int = None
+    map_seed: int = None
+    map_corpus: str = None
+    instrumentation: bool = False
+    trace: bool = False
+    trace_chunk_size: int = 1024
+    histogram_bins: int = 0
+
+    def __post_init__(self):
+        self.validate()
+
+    def validate(self):
+        """Raises a ValueError if any parameter is not valid."""
+        if self.agent_type not in AGENT_TYPES:
+            raise ValueError(f"Agent type inserted in the config file must be one of {', '.join(AGENT_TYPES)}.")
+        if self.map_size < 7 or (self.map_size > 26 and self.is_graphical()):
+            raise ValueError("Map size inserted in the config file must be between 7 and 26, both inclusive, "
+                             "or greater than 7 inclusive without the graphical interface.")
+        if self.fertile_land_ratio < 0.5 or self.fertile_land_ratio > 0.85:
+            raise ValueError("Fertile land ratio inserted in the config file must be between 0.5 and 0.85, both inclusive.")
+        if self.max_number_of_seeds < 5:
+            raise ValueError("Max number of seeds inserted in the config file must be greater than 5 inclusive.")
+        if self.max_battery_capacity < 2 * self.map_size:
+            raise ValueError("Max battery capacity inserted in the config file must be greater than 2 * map_size.")
+        if self.n_runs <= 0:
+            raise ValueError("Number of runs inserted in the config file must be greater than 0.")
+        if any(nr_agents < 0 for nr_agents in self.nr_agents.values()):
+            raise ValueError("Number of agents inserted in the config file must be greater than 0 inclusive.")
+        if self.timestep < 0:
+            raise ValueError("Timestep inserted in the config file must be greater than 0 inclusive.")
+        if self.n_workers <= 0:
+            raise ValueError("Number of workers must be greater than 0.")
+        if self.trace_chunk_size <= 0:
+            raise ValueError("Trace chunk size inserted in the config file must be greater than 0.")
+        if self.histogram_bins < 0:
+            raise ValueError("Histogram bins inserted in the config file must be greater than 0 inclusive.")
+        if self.batch_size < 0:
+            raise ValueError("Batch size must be greater than 0 inclusive.")
+        if self.batch_size > 0 and self.agent_type not in BATCHED_AGENT_TYPES:
+            raise ValueError(f"Batched runs are only available for {', '.join(BATCHED_AGENT_TYPES)}.")
+        # The batched policies always find paths in closed form and record nothing but the metrics.
+        if self.batch_size > 0 and self.path_finding != "chebyshev":
+            raise ValueError("Path finding inserted in the config file must be chebyshev for batched runs.")
+        if self.batch_size > 0 and (self.instrumentation or self.trace or self.histogram_bins > 0):
+            raise ValueError("Instrumentation, trace and histograms are not available for batched runs.")
+        if self.path_finding not in PATH_FINDERS:
+            raise ValueError(f"Path finding inserted in the config file must be one of {', '.join(PATH_FINDERS)}.")
+        if self.map_sharing not in MAP_SHARING_MODES:
+            raise ValueError(f"Map sharing inserted in the config file must be one of {', '.join(MAP_SHARING_MODES)}.")
+
+    @classmethod
+    def from_dict(cls, data: dict, **overrides) -> "Config":
+        """
+        Creates the config from the contents of a config file. Missing parameters take their default value and
+        overrides that are not None take precedence over the file, e.g. command line flags.
+        """
+        fields = {field.name for field in dataclasses.fields(cls)}
+        unknown = [name for name in data if name not in fields and name not in AGENT_TYPES]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown parameters inserted in the config file: {', '.join(map(str, unknown))}.")
+        values = {name: value for name, value in data.items() if name in fields}
+        nr_agents = {agent_type: data[agent_type]["nr_agents"] for agent_type in AGENT_TYPES
+                     if isinstance(data.get(agent_type), dict) and "nr_agents" in data[agent_type]}
+        if len(nr_agents) > 0:
+            values["nr_agents"] = {**cls().nr_agents, **nr_agents}
+        values.update({name: value for name, value in overrides.items() if value is not None})
+        return cls(**values)
+
+    @classmethod
+    def load(cls, path: str = "./config.yml", **overrides) -> "Config":
+        """Reads the config file at path, see from_dict."""
+        with open(path, "r") as fp:
+            data = yaml.safe_load(fp)
+        return cls.from_dict(data, **overrides)
+
+    def is_graphical(self) -> bool:
+        """Returns True if the runs are shown in the graphical interface. Parallel and batched runs are always
+        headless."""
+        return not self.headless and self.n_workers == 1 and self.batch_size == 0
+
+    def get_num_agents(self) -> int:
+        """Returns the number of agents of the configured type."""
+        return self.nr_agents[self.agent_type]
@@ -1,66 +1,157 @@
+import argparse
+import glob
+import os
 import numpy as np
-import yaml
+from config import Config
 from grid import Cell
-from scipy.ndimage.filters import convolve
 
+# Probabilities of the ids of the cells before the fertile land is spread and the map is blurred.
+PROBABILITIES = np.array([0.1, 0.1, 0.1, 0.1, 0.6])
 
-def blur_map(map):
-    """Blurs the map."""
-    kernel = np.ones((3, 3))
-
-    blurred_map = convolve(map, kernel, mode='constant', cval=1.0)
-
-    norm_blurred_map = (blurred_map / blurred_map.max()) * 4
-    norm_blurred_map = norm_blurred_map.astype(int)
-    return norm_blurred_map
+# Lookup table from the generated ids to the cell codes stored by the map.
+CELL_MAPPING = {
+    0: Cell.FERTILE_LAND,
+    1: Cell.OAK_TREE,
+    2: Cell.PINE_TREE,
+    3: Cell.EUCALYPTUS_TREE,
+    4: Cell.OBSTACLE,
+    5: Cell.CHARGING_STATION,
+}
+CODE_MAPPING = np.array([CELL_MAPPING[i].value for i in range(len(CELL_MAPPING))], dtype=np.uint8)
 
+# Id of the charging stations in the generated maps.
+CHARGING_STATION_ID = 5
 
-class DefaultMap:
-    """Generates a random map with a charging station."""
-
-    cell_mapping = {
-        0: Cell.FERTILE_LAND,
-        1: Cell.OAK_TREE,
-        2: Cell.PINE_TREE,
-        3: Cell.EUCALYPTUS_TREE,
-        4: Cell.OBSTACLE,
-        5: Cell.CHARGING_STATION,
-    }
+# Number of cells whose cell type is sampled at once when generating a map.
+SAMPLING_BLOCK_SIZE = 1 << 16
 
-    def __init__(self):
-        with open("./config.yml", "r") as fp:
-            data = yaml.safe_load(fp)
 
-        size = data["map_size"]
-        fertile_land_ratio = data["fertile_land_ratio"]
-        nr_charging_stations = data["nr_charging_stations"]
-
-        if size < 7 or size > 26:
-            raise ValueError("Map size inserted in the config file must be between 7 and 26, both inclusive.")
-        if fertile_land_ratio < 0.5 or fertile_land_ratio > 0.85:
-            raise ValueError("Fertile land ratio inserted in the config file must be between 0.5 and 0.85, both inclusive.")
-
-        probabilities = [0.1, 0.1, 0.1, 0.1, 0.6]
-        self.integer_map = np.random.choice([0, 1, 2, 3, 4], (size, size), p=probabilities)
+def blur_map(map):
+    """
+    Blurs the map. Every cell becomes the sum of the 3x3 window around it, cells outside of the map counting as 1,
+    scaled so the largest sum is 4. Computed with shifted views of the padded map, so it scales to large maps.
+    """
+    height, width = map.shape
+    padded = np.pad(map.astype(np.int16), 1, mode='constant', constant_values=1)
+
+    blurred_map = np.zeros((height, width), dtype=np.int16)
+    for dy in range(3):
+        for dx in range(3):
+            blurred_map += padded[dy:dy + height, dx:dx + width]
+
+    norm_blurred_map = (blurred_map * 4) // blurred_map.max()
+    return norm_blurred_map.astype(np.uint8)
+
+
+def place_charging_stations(integer_map, nr_charging_stations, rng):
+    """
+    Places the charging stations on random cells that are not fertile land. Cells are drawn in batches and the
+    ones that cannot hold a station are rejected, without going through the whole map.
+    """
+    flat_map = integer_map.reshape(-1)
+    if np.count_nonzero(flat_map) < nr_charging_stations:
+        raise ValueError("Number of charging stations inserted in the config file must be at most the number of cells that are not fertile land.")
+
+    stations = np.empty(0, dtype=np.int64)
+    while len(stations) < nr_charging_stations:
+        candidates = rng.integers(flat_map.size, size=4 * nr_charging_stations)
+        candidates = np.concatenate([stations, candidates[flat_map[candidates] != 0]])
+        # Keeps the first occurrence of each cell, in the order they were drawn.
+        _, first = np.unique(candidates, return_index=True)
+        stations = candidates[np.sort(first)]
+    flat_map[stations[:nr_charging_stations]] = CHARGING_STATION_ID
+
+
+def sample_cell_types(size: int, rng: np.random.Generator) -> np.ndarray:
+    """
+    Samples the cell type of every cell of a size x size map by inverting the cumulative distribution, with
+    4 bytes per cell for the uniforms and 1 for the map. searchsorted compares in float64 and returns int64
+    indices, so it runs a block of rows at a time.
+    """
+    uniforms = rng.random((size, size), dtype=np.float32)
+    cumulative_probabilities = np.cumsum(PROBABILITIES)
+    integer_map = np.empty((size, size), dtype=np.uint8)
+    block = max(SAMPLING_BLOCK_SIZE // size, 1)
+    for start in range(0, size, block):
+        indices = np.searchsorted(cumulative_probabilities, uniforms[start:start + block], side='right')
+        integer_map[start:start + block] = np.minimum(indices, len(PROBABILITIES) - 1)
+    return integer_map
+
+
+def generate_map(size: int, fertile_land_ratio: float, nr_charging_stations: int, seed=None) -> np.ndarray:
+    """
+    Generates a random size x size map of cell codes with charging stations. Every step works on whole arrays,
+    so it scales to maps with millions of cells. The seed is anything np.random.default_rng accepts, e.g. an int
+    or a SeedSequence, and the same seed always generates the same map.
+    """
+    rng = np.random.default_rng(seed)
+
+    integer_map = sample_cell_types(size, rng)
+
+    # Drawing without replacement permutes the int64 indices of every cell, the peak of the generation.
+    n_fertile_land = int(fertile_land_ratio * size * size)
+    fertile_land_indices = rng.choice(size * size, n_fertile_land, replace=False)
+    integer_map.reshape(-1)[fertile_land_indices] = 0
+    integer_map = blur_map(integer_map)
+
+    place_charging_stations(integer_map, nr_charging_stations, rng)
+
+    return CODE_MAPPING[integer_map]
+
+
+def generate_corpus(directory: str, n_maps: int, size: int, fertile_land_ratio: float, nr_charging_stations: int,
+                    seed=None) -> list[str]:
+    """
+    Generates n_maps maps and saves each one as a .npy file in the directory. Every map gets its own seed spawned
+    from the seed, so the corpus is reproducible. Returns the paths of the maps.
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, map_seed in enumerate(np.random.SeedSequence(seed).spawn(n_maps)):
+        path = os.path.join(directory, f"map-{i:05d}.npy")
+        np.save(path, generate_map(size, fertile_land_ratio, nr_charging_stations, map_seed))
+        paths.append(path)
+    return paths
+
+
+def corpus_paths(directory: str) -> list[str]:
+    """Returns the paths of the maps of the corpus in the directory, in order."""
+    paths = sorted(glob.glob(os.path.join(directory, "*.npy")))
+    if len(paths) == 0:
+        raise ValueError(f"Map corpus inserted in the config file must be a directory with .npy maps, found none in {directory}.")
+    return paths
+
+
+def load_map(map) -> np.ndarray:
+    """
+    Returns the grid of a map given either as a grid or as the path of a .npy file. Files are memory mapped read
+    only, so runs only read the parts of the map they use and processes share the pages.
+    """
+    if isinstance(map, str):
+        return np.load(map, mmap_mode='r')
+    return map
 
-        n_fertile_land = int(fertile_land_ratio * size * size)
 
-        fertile_land_indices = np.random.choice(size * size, n_fertile_land, replace=False)
-        self.integer_map.ravel()[fertile_land_indices] = 0
-        self.integer_map = blur_map(self.integer_map)
+class DefaultMap:
+    """Generates a random map with a charging station."""
 
-        for _ in range(nr_charging_stations):
-            while True:
-                station_x = np.random.randint(size)
-                station_y = np.random.randint(size)
-                if self.integer_map[station_x][station_y] != 0 and self.integer_map[station_x][station_y] != 5:
-                    self.integer_map[station_x][station_y] = 5
-                    break
+    cell_mapping = CELL_MAPPING
 
-        self.vectorized_mapping = np.vectorize(self.cell_mapping.get)
-        self.MAP = self.vectorized_mapping(self.integer_map)
+    def __init__(self, config: Config, seed=None):
+        self.MAP = generate_map(config.map_size, config.fertile_land_ratio, config.nr_charging_stations,
+                                seed if seed is not None else config.map_seed)
 
 
-# Global map variable
-MAP = DefaultMap().MAP
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a corpus of maps with the parameters of the config file.")
+    parser.add_argument("directory", help="Directory where the maps are saved.")
+    parser.add_argument("--n-maps", type=int, default=100, help="Number of maps.")
+    parser.add_argument("--size", type=int, default=None, help="Size of the maps, map_size of the config file by default.")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the corpus, map_seed of the config file by default.")
+    parser.add_argument("--config", default="./config.yml", help="Path of the config file.")
+    args = parser.parse_args()
 
+    config = Config.load(args.config)
+    generate_corpus(args.directory, args.n_maps, args.size if args.size is not None else config.map_size,
+                    config.fertile_land_ratio, config.nr_charging_stations,
+                    args.seed if args.seed is not None else config.map_seed)
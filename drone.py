@@ -1,9 +1,11 @@
 import enum
 import numpy as np
-import yaml
 from agent import GreedyObservation, CommunicativeObservation
+from config import Config
 from grid import Map
 from grid import Cell
+from grid import Position
+from pathfinding import get_path_finder
 
 
 class Goal(enum.Enum):
@@ -53,11 +55,96 @@ class Action(enum.Enum):
     """Moves the drone down diagonally to the right square."""
 
 
+# Offsets (dx, dy) of the position each action moves a drone to, indexed by the action value.
+ACTION_OFFSETS = np.zeros((len(Action), 2), dtype=np.int64)
+for _action, _offset in {
+    Action.UP: (0, -1), Action.DOWN: (0, 1), Action.LEFT: (-1, 0), Action.RIGHT: (1, 0),
+    Action.UP_RIGHT: (1, -1), Action.UP_LEFT: (-1, -1), Action.DOWN_RIGHT: (1, 1), Action.DOWN_LEFT: (-1, 1),
+}.items():
+    ACTION_OFFSETS[_action.value] = _offset
+
+# Whether each action moves the drone, indexed by the action value.
+MOVING_ACTIONS = np.any(ACTION_OFFSETS != 0, axis=1)
+
+
+class Fleet:
+    """
+    Structure of arrays with the state of a group of drones: positions, batteries, seeds and distance counters,
+    indexed by the position of the drone in the fleet. Drones read and write their state through views into it,
+    so the environment can update every drone at once with array operations.
+    """
+
+    # Names of the per drone arrays.
+    ARRAYS = ("x", "y", "battery", "seeds", "total_distance", "distance_between_fertile_lands",
+              "energy_used_before_planted_tree", "dead")
+
+    def __init__(self, size: int):
+        self.x = np.zeros(size, dtype=np.int64)
+        self.y = np.zeros(size, dtype=np.int64)
+        self.battery = np.zeros(size, dtype=np.int64)
+        self.seeds = np.zeros((size, 3), dtype=np.int64)  # [OAK_TREE,PINE_TREE,EUCALYPTUS]
+        self.total_distance = np.zeros(size, dtype=np.int64)
+        self.distance_between_fertile_lands = np.zeros(size, dtype=np.int64)
+        self.energy_used_before_planted_tree = np.zeros(size, dtype=np.int64)
+        self.dead = np.zeros(size, dtype=bool)
+        self.drones = []
+
+    @classmethod
+    def of(cls, drones: list) -> "Fleet":
+        """Creates a fleet with the current state of the drones and makes the drones use it."""
+        fleet = cls(len(drones))
+        for index, drone in enumerate(drones):
+            for name in cls.ARRAYS:
+                getattr(fleet, name)[index] = getattr(drone.fleet, name)[drone.index]
+            drone.fleet = fleet
+            drone.index = index
+        fleet.drones = list(drones)
+        return fleet
+
+    def __len__(self) -> int:
+        return len(self.drones)
+
+    def get_drones(self) -> list:
+        """Returns the drones in the fleet."""
+        return self.drones
+
+    def move(self, actions: np.ndarray, mask: np.ndarray, height: int, width: int) -> None:
+        """Moves the drones in the mask by the offsets of their actions, unless they would leave the map."""
+        offsets = ACTION_OFFSETS[actions]
+        target_x = self.x + offsets[:, 0]
+        target_y = self.y + offsets[:, 1]
+        moving = mask & (target_x >= 0) & (target_x < width) & (target_y >= 0) & (target_y < height)
+        self.x[moving] = target_x[moving]
+        self.y[moving] = target_y[moving]
+
+    def update_metrics(self, mask: np.ndarray, on_fertile_land: np.ndarray) -> None:
+        """
+        Updates the metrics of the drones in the mask, given whether each drone was on fertile land when its
+        metrics were updated.
+        """
+        self.battery -= mask
+        self.total_distance += mask
+        self.distance_between_fertile_lands += mask
+        self.energy_used_before_planted_tree += mask
+        for index in np.flatnonzero(mask & on_fertile_land):
+            self.drones[index].distance_needed_to_identify_fertile_land.add(
+                self.distance_between_fertile_lands.item(index))
+            self.distance_between_fertile_lands[index] = 0
+
+
 class Drone:
     """Defines the drone."""
 
     def __init__(self, loc, id, max_number_of_seeds, max_battery_available, distance_between_fertile_lands,
-                 distance_needed_to_identify_fertile_land, energy_per_planted_tree, charging_station_loc):
+                 distance_needed_to_identify_fertile_land, energy_per_planted_tree, charging_station_loc, map: Map,
+                 config: Config):
+
+        # Until the drone joins a fleet, its state is kept in a fleet of its own.
+        self.fleet = Fleet(1)
+        self.fleet.drones.append(self)
+        self.index = 0
+        # Interned positions of the cells, shared with the maps of the same size.
+        self.position_table = map.position_table
 
         self.loc = loc
         self.id = id
@@ -75,13 +162,70 @@ class Drone:
         self.actions = [Action.UP, Action.DOWN, Action.LEFT, Action.RIGHT, Action.STAY, Action.PLANT, Action.CHARGE,
                         Action.UP_RIGHT, Action.UP_LEFT, Action.DOWN_RIGHT, Action.DOWN_LEFT]
 
-        with open("./config.yml", "r") as fp:
-            data = yaml.safe_load(fp)
-
-        # Every type of agent starts without knowing the map
-        self.map = Map(np.full((data["map_size"], data["map_size"]), Cell.UNKNOWN))
+        # Every type of agent starts without knowing the map, apart from what a shared map already knows
+        self.map = map
         self.charging_station = charging_station_loc
-        self.map.get_grid()[charging_station_loc.y, charging_station_loc.x] = Cell.CHARGING_STATION
+        self.map.change_cell_type(charging_station_loc, Cell.CHARGING_STATION)
+        self.path_finder = get_path_finder(config.path_finding)
+        self.map_sharing = config.map_sharing
+        self.plan = None
+
+    @property
+    def loc(self) -> Position:
+        return self.position_table.position(self.fleet.x.item(self.index), self.fleet.y.item(self.index))
+
+    @loc.setter
+    def loc(self, loc: Position):
+        self.fleet.x[self.index] = loc.x
+        self.fleet.y[self.index] = loc.y
+
+    @property
+    def battery_available(self) -> int:
+        return self.fleet.battery.item(self.index)
+
+    @battery_available.setter
+    def battery_available(self, battery_available: int):
+        self.fleet.battery[self.index] = battery_available
+
+    @property
+    def nr_seeds(self) -> np.ndarray:
+        return self.fleet.seeds[self.index]
+
+    @nr_seeds.setter
+    def nr_seeds(self, nr_seeds: list):
+        self.fleet.seeds[self.index] = nr_seeds
+
+    @property
+    def total_distance(self) -> int:
+        return self.fleet.total_distance.item(self.index)
+
+    @total_distance.setter
+    def total_distance(self, total_distance: int):
+        self.fleet.total_distance[self.index] = total_distance
+
+    @property
+    def distance_between_fertile_lands(self) -> int:
+        return self.fleet.distance_between_fertile_lands.item(self.index)
+
+    @distance_between_fertile_lands.setter
+    def distance_between_fertile_lands(self, distance: int):
+        self.fleet.distance_between_fertile_lands[self.index] = distance
+
+    @property
+    def energy_used_before_planted_tree(self) -> int:
+        return self.fleet.energy_used_before_planted_tree.item(self.index)
+
+    @energy_used_before_planted_tree.setter
+    def energy_used_before_planted_tree(self, energy: int):
+        self.fleet.energy_used_before_planted_tree[self.index] = energy
+
+    @property
+    def is_dead(self) -> bool:
+        return self.fleet.dead.item(self.index)
+
+    @is_dead.setter
+    def is_dead(self, is_dead: bool):
+        self.fleet.dead[self.index] = is_dead
 
     def set_dead(self):
         """Sets drone as dead."""
@@ -99,6 +243,27 @@ class Drone:
         """Returns drone's map."""
         return self.map
 
+    def set_map(self, map: Map):
+        """Sets drone's map, e.g. to the blackboard map shared by a fleet."""
+        self.map = map
+        self.plan = None
+
+    def get_map_sharing(self):
+        """Returns how the drone shares its knowledge of the map with the other drones."""
+        return self.map_sharing
+
+    def get_path_finder(self):
+        """Returns the path finding engine used by the drone."""
+        return self.path_finder
+
+    def get_plan(self):
+        """Returns the plan the drone is following, if any."""
+        return self.plan
+
+    def set_plan(self, plan):
+        """Sets the plan the drone is following."""
+        self.plan = plan
+
     def get_max_battery_available(self):
         """Returns drone's max battery available."""
         return self.max_battery_available
@@ -133,7 +298,7 @@ class Drone:
             tree_id = map.get_type_of_tree_that_should_be_planted(self.loc)
             if self.nr_seeds[tree_id] > 0:
                 self.nr_seeds[tree_id] -= 1
-                self.energy_per_planted_tree.append(self.energy_used_before_planted_tree)
+                self.energy_per_planted_tree.add(self.energy_used_before_planted_tree)
                 self.energy_used_before_planted_tree = 0
                 return True, map.map_id_to_cell_type(tree_id)
             else:
@@ -145,27 +310,13 @@ class Drone:
 
     def move(self, action: Action):
         """Move a drone according to an action."""
-        target_loc = None
-
-        if action == Action.UP:
-            target_loc = self.loc.up
-        elif action == Action.DOWN:
-            target_loc = self.loc.down
-        elif action == Action.RIGHT:
-            target_loc = self.loc.right
-        elif action == Action.LEFT:
-            target_loc = self.loc.left
-        elif action == Action.UP_RIGHT:
-            target_loc = self.loc.up_right
-        elif action == Action.UP_LEFT:
-            target_loc = self.loc.up_left
-        elif action == Action.DOWN_RIGHT:
-            target_loc = self.loc.down_right
-        elif action == Action.DOWN_LEFT:
-            target_loc = self.loc.down_left
-
-        if self.map.is_inside_map(target_loc):
-            self.loc = target_loc
+        dx, dy = ACTION_OFFSETS[action.value]
+        target_x = self.fleet.x.item(self.index) + int(dx)
+        target_y = self.fleet.y.item(self.index) + int(dy)
+
+        if 0 <= target_y < self.map.height and 0 <= target_x < self.map.width:
+            self.fleet.x[self.index] = target_x
+            self.fleet.y[self.index] = target_y
 
     def update_metrics(self, map: Map):
         """Updates drone's metrics."""
@@ -178,13 +329,13 @@ class Drone:
     def update_distance_needed_to_identify_fertile_land(self, map: Map):
         """Updates distance needed to identify fertile land."""
         if map.is_fertile_land(self.loc):
-            self.distance_needed_to_identify_fertile_land.append(self.distance_between_fertile_lands)
+            self.distance_needed_to_identify_fertile_land.add(self.distance_between_fertile_lands)
             self.distance_between_fertile_lands = 0
 
     def get_avg_of_drone_energy_used_per_planted_tree(self):
         """Returns the average of the energy used per planted tree."""
-        if len(self.energy_per_planted_tree) != 0:
-            return np.mean(self.energy_per_planted_tree)
+        if self.energy_per_planted_tree.get_count() != 0:
+            return self.energy_per_planted_tree.get_mean()
         else:
             return -1
 
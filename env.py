@@ -1,6 +1,7 @@
 import numpy as np
 from agent import CommunicativeAgent
-from grid import Map
+from drone import Action, Fleet, MOVING_ACTIONS
+from grid import Cell, Map
 
 
 class Environment:
@@ -10,7 +11,9 @@ class Environment:
         self.occupied_squares_with_drones = []
         self.map = map
         self.printer = printer
-        self.rng = np.random.default_rng()
+        # The only randomness of the environment is the type of the planted trees, drawn by its map.
+        self.rng = map.rng
+        self.fleet = None
 
     def get_map(self) -> Map:
         """Returns the map of the environment."""
@@ -24,54 +27,71 @@ class Environment:
         """Returns the current timestep."""
         return self.timestep
 
+    def get_fleet(self, agents) -> Fleet:
+        """Returns the fleet with the drones of the agents, created again when the agents get new drones."""
+        drones = [agent.get_drone() for agent in agents]
+        if self.fleet is None or self.fleet.get_drones() != drones:
+            self.fleet = Fleet.of(drones)
+        return self.fleet
+
     def step(self, actions, agents) -> bool:
-        from drone import Action
+        """
+        Performs a step in the environment. Moves, battery drain, deaths and metrics are applied to the whole fleet
+        with array operations, only planting and charging go through the drones one by one, in the order of the
+        agents, since they depend on each other.
+        """
+        fleet = self.get_fleet(agents)
+        actions = np.fromiter((Action.STAY.value if act is None else act.value for act in actions),
+                              dtype=np.int64, count=len(fleet))
 
-        """Performs a step in the environment."""
+        # Unless the drone has energy, it cant do actions.
+        active = fleet.battery != 0
+        fleet.dead |= ~active
+        updated = active.copy()
 
         # Garantees that the charging station only has one drone charging at
         # each timestep. Only valid for Random and Greedy agents.
         # Since for the Communicative agent they communicate with each other.
         CHARGING_STATION_FULL = False
 
-        # Perform agents actions
-        for agent, act in zip(agents, actions):
-            drone = agent.get_drone()
-            if drone.get_battery_available() != 0: # Unless the drone has energy, it cant do actions.
-                if act in (Action.UP, Action.DOWN, Action.LEFT, Action.RIGHT,
-                           Action.UP_RIGHT, Action.UP_LEFT, Action.DOWN_RIGHT, Action.DOWN_LEFT):
-                    # Enters if a moving action was chosen.
-                    drone.move(act)
+        # Squares planted in this step and the index of the drone that planted each one.
+        planted_squares = {}
+        for index in np.flatnonzero(active & ((actions == Action.PLANT.value) | (actions == Action.CHARGE.value))):
+            agent = agents[index]
+            drone = fleet.get_drones()[index]
+            if actions[index] == Action.PLANT.value:
+                p = drone.get_loc()
+                planted_with_sucess, s = drone.plant(self.map)
+                if planted_with_sucess:
+                    self.map.change_cell_type(p, s)
+                    self.map.add_planted_square(p, s)
+                    drone.get_map().add_planted_square(p, s)
+                    planted_squares[p] = index
 
-                elif act == Action.PLANT:
-                    p = drone.get_loc()
-                    planted_with_sucess, s = drone.plant(self.map)
-                    if planted_with_sucess:
-                        self.map.change_cell_type(p, s)
-                        self.map.add_planted_square(p, s)
-                        drone.get_map().add_planted_square(p, s)
+            elif not isinstance(agent, CommunicativeAgent):
+                if CHARGING_STATION_FULL:
+                    updated[index] = False
+                    continue
+                drone.charge()
+                CHARGING_STATION_FULL = True
+            else:
+                # Cooperative charging strategy.
+                agent_id_with_the_highest_priority = agent.get_cooperative_charging_strategy().run(agent, self.timestep)
+                if agent_id_with_the_highest_priority == agent.get_id():
+                    drone.charge()
+                else:
+                    updated[index] = False
 
-                elif act == Action.CHARGE:
-                    if not isinstance(agent, CommunicativeAgent):
-                        if CHARGING_STATION_FULL:
-                            continue
-                        drone.charge()
-                        CHARGING_STATION_FULL = True
-                    else:
-                        # Cooperative charging strategy.
-                        agent_id_with_the_highest_priority = agent.get_cooperative_charging_strategy().run(agent, self.timestep)
-                        if agent_id_with_the_highest_priority == agent.get_id():
-                            drone.charge()
-                        else:
-                            continue
-                elif act == Action.STAY:
-                    pass
+        fleet.move(actions, active & MOVING_ACTIONS[actions], self.map.height, self.map.width)
 
-                drone.update_metrics(self.map)
+        # Each drone looks for fertile land before the drones after it act, so a square planted in this step
+        # was still fertile land for the drones before the one that planted it.
+        on_fertile_land = self.map.get_grid()[fleet.y, fleet.x] == Cell.FERTILE_LAND.value
+        for p, planter in planted_squares.items():
+            on_fertile_land[:planter] |= (fleet.x[:planter] == p.x) & (fleet.y[:planter] == p.y)
+        fleet.update_metrics(updated, on_fertile_land)
 
-            else:
-                drone.set_dead()
         self.timestep += 1
 
         # Return True if all the initial fertile land squares are planted with trees
-        return len(self.map.plantable_squares()) == 0
+        return self.map.number_of_plantable_squares() == 0
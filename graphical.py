@@ -1,112 +1,154 @@
 import abc
+import os
 import numpy as np
 import pygame
 from typing import Tuple
-from grid import Position, Cell
+from grid import Position, Cell, CELL_TYPES
 from drone import Drone
+from instrumentation import INSTRUMENTATION
+from printer import Printer
 
 
-class Printer(abc.ABC):
-    """Abstract base class for all printers."""
-    @abc.abstractmethod
-    def print(self, env, drones) -> None:
-        pass
+# Directory of this module, the paths of the sprites are relative to it so they are found whatever the working
+# directory.
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class SpriteAtlas:
+    """Loads every sprite from disk and scales it to the cell size once, to be shared by all printers."""
+
+    # Image of each cell type.
+    cell_images = {
+        Cell.FERTILE_LAND: "Images/Fertile.png",
+        Cell.OAK_TREE: "Images/Oak.png",
+        Cell.PINE_TREE: "Images/Pine.png",
+        Cell.EUCALYPTUS_TREE: "Images/Eucalyptus.png",
+        Cell.CHARGING_STATION: "Images/Station.png",
+        Cell.OBSTACLE: "Images/Obstacle.png",
+    }
+    drone_image = "Images/Drone.png"
+    dead_drone_image = "Images/coffin.png"
+
+    def __init__(self, cell_width: int, cell_height: int):
+        cell_size = (cell_width, cell_height)
+        drone_size = (0.8 * cell_width, 0.8 * cell_height)
+        self.cells = {cell_type: self.load(path, cell_size) for cell_type, path in self.cell_images.items()}
+        self.drone = self.load(self.drone_image, drone_size)
+        self.dead_drone = self.load(self.dead_drone_image, drone_size)
+
+    @staticmethod
+    def load(path: str, size: Tuple[float, float]) -> pygame.Surface:
+        """Loads an image, given relative to the directory of this module, and scales it to the given size."""
+        path = os.path.join(MODULE_DIRECTORY, path)
+        return pygame.transform.scale(pygame.image.load(path), size).convert_alpha()
+
+    def get_cell(self, cell_type: Cell) -> pygame.Surface:
+        """Returns the sprite of a cell type."""
+        return self.cells[cell_type]
+
+    def get_drone(self, is_dead: bool) -> pygame.Surface:
+        """Returns the sprite of a drone."""
+        return self.dead_drone if is_dead else self.drone
 
 
 class EnvironmentPrinter(Printer):
-    """Prints the environment."""
+    """Prints the environment.
+    The static terrain is drawn once into a background surface, and afterwards only the cells that changed and
+    the cells drones left or entered are redrawn and updated on the display."""
     def __init__(self, grid: np.array):
         self.grid = grid
+        self.background = None
+        self.drone_positions = []
 
     def print(self, env, drones) -> None:
         """Prints the environment."""
         local_map = env.get_map()
-        env_grid = local_map.get_grid()
-        n_cols, n_rows = env_grid.shape
-
-        cell_height = self.__height // n_cols
-        cell_width = self.__width // n_rows
-
-        # Print grid squares of different types
-        fertile_land_printer = FertileLandPrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        oak_tree_printer = OakTreePrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        pine_tree_printer = PineTreePrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        eucalyptus_tree_printer = EucalyptusTreePrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        charging_station_printer = ChargingStationPrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        obstacle_printer = ObstaclePrinter(
-            screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
-        )
-        local_map = env.get_map()
-        for pos in local_map.all_positions:
-            if local_map.is_fertile_land(pos):
-                fertile_land_printer.print(pos)
-            elif local_map.is_oak_tree(pos):
-                oak_tree_printer.print(pos)
-            elif local_map.is_pine_tree(pos):
-                pine_tree_printer.print(pos)
-            elif local_map.is_eucalyptus_tree(pos):
-                eucalyptus_tree_printer.print(pos)
-            elif local_map.is_charging_station(pos):
-                charging_station_printer.print(pos)
-            elif local_map.is_obstacle(pos):
-                obstacle_printer.print(pos)
-            else:
+        if self.background is None:
+            self.print_background(local_map)
+            self.add_colour_to_planted_squares(env)
+            for drone in drones:
+                self.__drone_printer.print(drone)
+            pygame.display.flip()
+        else:
+            dirty_positions = local_map.pop_changed_positions()
+            dirty_positions.update(self.drone_positions)
+            dirty_positions.update(drone.get_loc() for drone in drones)
+            dirty_rects = [self.print_cell(local_map, pos) for pos in dirty_positions]
+            INSTRUMENTATION.count("cells_redrawn", len(dirty_rects))
+
+            # Every drone is in a dirty cell, so they are all drawn again on top of it.
+            for drone in drones:
+                self.__drone_printer.print(drone)
+            pygame.display.update(dirty_rects)
+
+        self.drone_positions = [drone.get_loc() for drone in drones]
+
+    def print_background(self, local_map) -> None:
+        """Prints the initial cells of the map and keeps them as the background."""
+        initial_grid = local_map.get_initial_grid()
+        for pos in (local_map.position(x, y) for x in range(local_map.width) for y in range(local_map.height)):
+            cell_type = CELL_TYPES[initial_grid.item(pos.y, pos.x)]
+            if cell_type not in self.__cell_printers:
                 raise ValueError(f"Position not road or sidewalk: {pos}")
+            self.__cell_printers[cell_type].print(pos)
+        INSTRUMENTATION.count("cells_redrawn", local_map.height * local_map.width)
+        self.background = self.__screen.copy()
 
-        self.add_colour_to_planted_squares(env)
-
-        # Print drones
-        drone_printer = DronePrinter(
-            screen=self.__screen,
-            cell_width=cell_width,
-            cell_height=cell_height,
-        )
-        for drone in drones:
-            drone_printer.print(drone)
+        # From now on, only the cells that change are printed again.
+        local_map.start_tracking_changes()
 
-        pygame.display.flip()
+    def print_cell(self, local_map, pos: Position) -> pygame.Rect:
+        """Prints the background and the current cell type of a position and returns the area printed."""
+        rect = pygame.Rect(pos.x * self.__cell_width, pos.y * self.__cell_height,
+                           self.__cell_width, self.__cell_height)
+        self.__screen.blit(self.background, rect, rect)
+        self.__cell_printers[local_map.get_cell_type(pos)].print(pos)
+        return rect
 
     def add_colour_to_planted_squares(self, env):
         """Adds colour to planted squares."""
         planted_squares = env.get_map().get_planted_squares()
-        env_grid = env.get_map().get_grid()
-        n_cols, n_rows = env_grid.shape
-
-        assert self.__height % n_cols == 0, "display height is not divisible by number of columns in grid"
-        assert self.__width % n_rows == 0, "display width is not divisible by number of rows in grid"
-
-        cell_height = self.__height // n_cols
-        cell_width = self.__width // n_rows
 
         for tuples in planted_squares:
             pos = tuples[0]
             cell_type = tuples[1]
-            if cell_type == Cell.OAK_TREE:
-                OakTreePrinter(screen=self.__screen, cell_width=cell_width, cell_height=cell_height, ).print(pos)
-            if cell_type == Cell.PINE_TREE:
-                PineTreePrinter(screen=self.__screen, cell_width=cell_width, cell_height=cell_height, ).print(pos)
-            if cell_type == Cell.EUCALYPTUS_TREE:
-                EucalyptusTreePrinter(screen=self.__screen, cell_width=cell_width, cell_height=cell_height, ).print(pos)
+            self.__cell_printers[cell_type].print(pos)
 
         return None
 
     def __enter__(self):
-        """Initialises pygame and sets the screen size."""
+        """Initialises pygame, sets the screen size and loads the sprites for the cell size."""
         pygame.init()
         n_cells = self.grid.shape[0] * self.grid.shape[1]
         self.__width = self.__height = ((min(pygame.display.Info().current_w,
                                              pygame.display.Info().current_h) * 0.8) // n_cells) * n_cells
         self.__screen = pygame.display.set_mode((self.__width, self.__height))
+
+        n_cols, n_rows = self.grid.shape
+        assert self.__height % n_cols == 0, "display height is not divisible by number of columns in grid"
+        assert self.__width % n_rows == 0, "display width is not divisible by number of rows in grid"
+        cell_height = self.__height // n_cols
+        cell_width = self.__width // n_rows
+        self.__cell_width = cell_width
+        self.__cell_height = cell_height
+
+        # Printers are created once and share the sprites.
+        sprites = SpriteAtlas(cell_width=cell_width, cell_height=cell_height)
+        printer_types = {
+            Cell.FERTILE_LAND: FertileLandPrinter,
+            Cell.OAK_TREE: OakTreePrinter,
+            Cell.PINE_TREE: PineTreePrinter,
+            Cell.EUCALYPTUS_TREE: EucalyptusTreePrinter,
+            Cell.CHARGING_STATION: ChargingStationPrinter,
+            Cell.OBSTACLE: ObstaclePrinter,
+        }
+        self.__cell_printers = {
+            cell_type: printer_type(screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
+                                    sprites=sprites)
+            for cell_type, printer_type in printer_types.items()
+        }
+        self.__drone_printer = DronePrinter(screen=self.__screen, cell_width=cell_width, cell_height=cell_height,
+                                            sprites=sprites)
         return self
 
     def __exit__(self, ex_type, ex_val, ex_traceback) -> bool:
@@ -117,10 +159,11 @@ class EnvironmentPrinter(Printer):
 
 class BasePrinter:
     """Abstract base class for all cell printers."""
-    def __init__(self, screen: pygame.Surface, cell_width: int, cell_height: int):
+    def __init__(self, screen: pygame.Surface, cell_width: int, cell_height: int, sprites: SpriteAtlas):
         self._screen = screen
         self._cell_width = cell_width
         self._cell_height = cell_height
+        self._sprites = sprites
 
     def get_upper_left(self, pos: Position) -> Tuple[int, int]:
         """Computes the upper left corner for a given position."""
@@ -153,56 +196,49 @@ class CellPrinter(abc.ABC, BasePrinter):
 class FertileLandPrinter(CellPrinter):
     """Prints fertile land."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Fertile.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.FERTILE_LAND)
 
 
 class OakTreePrinter(CellPrinter):
     """Prints oak trees."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Oak.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.OAK_TREE)
 
 
 class PineTreePrinter(CellPrinter):
     """Prints pine trees."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Pine.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.PINE_TREE)
 
 
 class EucalyptusTreePrinter(CellPrinter):
     """Prints eucalyptus trees."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Eucalyptus.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.EUCALYPTUS_TREE)
 
 
 class ChargingStationPrinter(CellPrinter):
     """Prints charging stations."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Station.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.CHARGING_STATION)
 
 
 class ObstaclePrinter(CellPrinter):
     """Prints obstacles."""
     def colour(self) -> pygame.Surface:
-        return pygame.transform.scale(pygame.image.load("Images/Obstacle.png"), (self._cell_width, self._cell_height))
+        return self._sprites.get_cell(Cell.OBSTACLE)
 
 
 class DronePrinter(BasePrinter):
     """Prints drones."""
-    def __init__(self, screen: pygame.Surface, cell_width: int, cell_height: int):
-        super().__init__(screen=screen, cell_width=cell_width, cell_height=cell_height)
+    def __init__(self, screen: pygame.Surface, cell_width: int, cell_height: int, sprites: SpriteAtlas):
+        super().__init__(screen=screen, cell_width=cell_width, cell_height=cell_height, sprites=sprites)
 
     def print(self, d: Drone) -> None:
         """Draws a drone icon for the given drone."""
-        if d.is_drone_dead():
-            drone_icon = pygame.transform.scale(pygame.image.load("Images/coffin.png"),
-                                                (0.8 * self._cell_width, 0.8 * self._cell_height))
-        else:
-            drone_icon = pygame.transform.scale(pygame.image.load("Images/Drone.png"),
-                                                (0.8 * self._cell_width, 0.8 * self._cell_height))
+        drone_icon = self._sprites.get_drone(d.is_drone_dead())
 
         left = d.loc.x * self._cell_width + 0.1 * self._cell_width
         top = d.loc.y * self._cell_height + 0.1 * self._cell_height
 
-        drone_sprite = pygame.transform.rotate(drone_icon, 0)
-
-        self._screen.blit(drone_sprite, (left, top))
+        self._screen.blit(drone_icon, (left, top))
@@ -1,13 +1,16 @@
 import dataclasses
 import enum
+import functools
 import numpy as np
 from typing import List
-import random
+from instrumentation import INSTRUMENTATION
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(frozen=True, slots=True)
 class Position:
-    """Represents the coordinates of a grid position."""
+    """Represents the coordinates of a grid position.
+    Maps intern one position per cell, see PositionTable, so positions taken from a map are shared and not
+    allocated again."""
     x: int
     y: int
 
@@ -46,22 +49,22 @@ class Position:
     @property
     def up_right(self) -> "Position":
         """Position up and to the right of this position."""
-        return self.up.right
+        return Position(x=self.x + 1, y=self.y - 1)
 
     @property
     def up_left(self) -> "Position":
         """Position up and to the left of this position."""
-        return self.up.left
+        return Position(x=self.x - 1, y=self.y - 1)
 
     @property
     def down_left(self) -> "Position":
         """Position down and to the left of this position."""
-        return self.down.left
+        return Position(x=self.x - 1, y=self.y + 1)
 
     @property
     def down_right(self) -> "Position":
         """Position down and to the right of this position."""
-        return self.down.right
+        return Position(x=self.x + 1, y=self.y + 1)
 
     @property
     def adj(self) -> "List[Position]":
@@ -71,6 +74,62 @@ class Position:
                 self.down_left, self.down_right]
 
 
+# Offsets (dx, dy) of the adjacent cells, in the same order as Position.adj.
+NEIGHBOUR_OFFSETS = ((0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1))
+
+
+class PositionTable:
+    """
+    Interned positions and neighbours of the cells of a height x width grid, shared by all the maps of that shape.
+    Cells are numbered by their flat index y * width + x. Nothing is built up front: the position of a cell and its
+    neighbours, computed from the flat index in the order of Position.adj, are created the first time they are
+    asked for and reused afterwards, so the table only grows with the cells that are used, whatever the map size.
+    """
+
+    def __init__(self, height: int, width: int):
+        self.height = height
+        self.width = width
+        self.positions = {}
+        self.neighbour_indices = {}
+        self.neighbour_positions = {}
+
+    def position_at(self, index: int) -> Position:
+        """Returns the position of the cell with the flat index."""
+        position = self.positions.get(index)
+        if position is None:
+            y, x = divmod(index, self.width)
+            position = self.positions[index] = Position(x=x, y=y)
+        return position
+
+    def position(self, x: int, y: int) -> Position:
+        """Returns the position of the cell (x, y)."""
+        return self.position_at(y * self.width + x)
+
+    def neighbours_of(self, index: int) -> list[int]:
+        """Returns the flat indices of the neighbours of the cell with the flat index."""
+        neighbours = self.neighbour_indices.get(index)
+        if neighbours is None:
+            y, x = divmod(index, self.width)
+            neighbours = self.neighbour_indices[index] = [
+                (y + dy) * self.width + x + dx for dx, dy in NEIGHBOUR_OFFSETS
+                if 0 <= x + dx < self.width and 0 <= y + dy < self.height]
+        return neighbours
+
+    def adj_positions(self, index: int) -> tuple[Position, ...]:
+        """Returns the positions of the neighbours of the cell with the flat index."""
+        positions = self.neighbour_positions.get(index)
+        if positions is None:
+            positions = self.neighbour_positions[index] = \
+                tuple(self.position_at(neighbour) for neighbour in self.neighbours_of(index))
+        return positions
+
+
+@functools.lru_cache(maxsize=8)
+def get_position_table(height: int, width: int) -> PositionTable:
+    """Returns the position table of the height x width grids, shared by the maps of that shape."""
+    return PositionTable(height, width)
+
+
 class Cell(enum.Enum):
     """Represents each cell of the grid."""
     FERTILE_LAND = 0
@@ -82,43 +141,157 @@ class Cell(enum.Enum):
     UNKNOWN = 6
 
 
-class Map:
-    """Represents the combination of the grid with the cell values."""
+# Cell types indexed by their code, as stored in the map grid.
+CELL_TYPES = tuple(Cell)
+
+# Codes of the cells that hold a tree.
+TREE_CODES = np.array([Cell.OAK_TREE.value, Cell.PINE_TREE.value, Cell.EUCALYPTUS_TREE.value], dtype=np.uint8)
+TREE_VALUES = frozenset(TREE_CODES.tolist())
+
+
+def cells_to_codes(grid: np.ndarray) -> np.ndarray:
+    """Converts a grid of cell types into a grid of cell codes. Grids of codes are used as they are, without a copy,
+    so memory mapped maps stay on disk."""
+    if grid.dtype != object:
+        return grid.astype(np.uint8, copy=False)
+    codes = np.empty(grid.shape, dtype=np.uint8)
+    for cell in Cell:
+        codes[grid == cell] = cell.value
+    return codes
+
+
+def scan_order(p: Position) -> tuple[int, int]:
+    """Sort key that orders positions as a column by column scan of the grid.
+    Indexed positions are returned in this order so that ties between them are always broken the same way."""
+    return p.x, p.y
 
-    def __init__(self, grid: np.ndarray):
-        self.initial_grid = np.copy(grid)
-        self.initial_number_of_plantable_squares = np.count_nonzero(self.initial_grid == Cell.FERTILE_LAND)
-        self.grid = np.copy(grid)
-        self.planted_squares = self.calculate_planted_squares()
+
+def create_unknown_map(height: int, width: int) -> "Map":
+    """Returns a height x width map of unknown cells, the map a drone starts with."""
+    return Map(np.full((height, width), Cell.UNKNOWN.value, dtype=np.uint8))
+
+
+class Map:
+    """Represents the combination of the grid with the cell values.
+    The grid stores the value of each cell type as an uint8 code.
+    The number of fertile land and planted squares and the charging stations are counted and kept up to date
+    on every cell change, so the grid must only be modified through change_cell_type or update_position.
+    The positions of a cell class are only built when they are asked for, with a scan of the grid, so the per step
+    queries of the simulation only read the counters and single cells, and the lists of positions are left to one
+    off uses such as drawing the first frame."""
+
+    def __init__(self, grid: np.ndarray, rng: np.random.Generator = None):
+        self.initial_grid = cells_to_codes(grid)
+        # Breaks the ties between the types of tree that can be planted.
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.initial_number_of_plantable_squares = np.count_nonzero(self.initial_grid == Cell.FERTILE_LAND.value)
+        self.grid = np.copy(self.initial_grid)
+        self.position_table = get_position_table(*self.grid.shape)
+        self.obstacles_version = 0
+        self.fertile_land_version = 0
+        self.changed_positions = None
+        self.build_indexes()
 
     def reset(self):
         """Resets the map to its initial state."""
         self.grid = np.copy(self.initial_grid)
-        self.planted_squares = self.calculate_planted_squares()
-
-    def update_planted_squares(self):
-        """Updates the planted squares."""
-        self.planted_squares = self.calculate_planted_squares()
+        self.changed_positions = None
+        self.build_indexes()
+
+    def start_tracking_changes(self):
+        """Starts recording the positions whose cell type changes, e.g. to redraw only those."""
+        self.changed_positions = set()
+
+    def pop_changed_positions(self) -> set[Position]:
+        """Returns the positions whose cell type changed since the last call and forgets them."""
+        changed_positions = self.changed_positions
+        self.changed_positions = set()
+        return changed_positions
+
+    def build_indexes(self):
+        """Builds the counters and the charging stations index from the grid, with array operations only."""
+        # The masks count their own scans, these are the charging stations and the initial fertile land.
+        INSTRUMENTATION.count("full_grid_scans", 2)
+        self.n_fertile_land = int(np.count_nonzero(self.fertile_land_mask()))
+        # Flat indices of the charging stations, which are few.
+        self.charging_station_indices = set(np.flatnonzero(self.grid == Cell.CHARGING_STATION.value).tolist())
+        self.n_planted_squares = int(np.count_nonzero((self.initial_grid == Cell.FERTILE_LAND.value) & self.tree_mask()))
+        # Lets path finding engines and plans know when what they computed may no longer be valid.
+        self.obstacles_version += 1
+        self.fertile_land_version += 1
+        # Flat indices of the cells that became fertile land since, one per fertile land version from this one.
+        self.added_fertile_land = []
+        self.added_fertile_land_version = self.fertile_land_version
+
+    def update_indexes(self, p: Position, old_code: int, new_code: int):
+        """Updates the counters and the charging stations index for the change of the position p from the old cell
+        code to the new one."""
+        if old_code == Cell.OBSTACLE.value or new_code == Cell.OBSTACLE.value:
+            self.obstacles_version += 1
+
+        if old_code == Cell.FERTILE_LAND.value:
+            self.n_fertile_land -= 1
+        elif old_code == Cell.CHARGING_STATION.value:
+            self.charging_station_indices.discard(p.y * self.width + p.x)
+        elif old_code in TREE_VALUES:
+            if self.is_initially_fertile_land(p):
+                self.n_planted_squares -= 1
+
+        if new_code == Cell.FERTILE_LAND.value:
+            self.n_fertile_land += 1
+            self.fertile_land_version += 1
+            self.added_fertile_land.append(p.y * self.width + p.x)
+        elif new_code == Cell.CHARGING_STATION.value:
+            self.charging_station_indices.add(p.y * self.width + p.x)
+        elif new_code in TREE_VALUES:
+            if self.is_initially_fertile_land(p):
+                self.n_planted_squares += 1
 
     def get_initial_number_of_plantable_squares(self):
         """Returns the initial number of plantable squares."""
         return self.initial_number_of_plantable_squares
 
     def get_grid(self):
-        """Returns the grid."""
+        """Returns the grid of cell codes."""
         return self.grid
 
     def get_initial_grid(self):
-        """Returns the initial grid."""
+        """Returns the initial grid of cell codes."""
         return self.initial_grid
 
+    def fertile_land_mask(self) -> np.ndarray:
+        """Returns a boolean mask of the fertile land cells."""
+        INSTRUMENTATION.count("full_grid_scans")
+        return self.grid == Cell.FERTILE_LAND.value
+
+    def tree_mask(self) -> np.ndarray:
+        """Returns a boolean mask of the cells with a tree."""
+        INSTRUMENTATION.count("full_grid_scans")
+        return np.isin(self.grid, TREE_CODES)
+
+    def unknown_mask(self) -> np.ndarray:
+        """Returns a boolean mask of the unknown cells."""
+        INSTRUMENTATION.count("full_grid_scans")
+        return self.grid == Cell.UNKNOWN.value
+
+    def obstacle_mask(self) -> np.ndarray:
+        """Returns a boolean mask of the obstacle cells."""
+        INSTRUMENTATION.count("full_grid_scans")
+        return self.grid == Cell.OBSTACLE.value
+
+    def positions_of(self, mask: np.ndarray) -> List[Position]:
+        """Returns the positions marked in the mask in scan order, column by column, found with a single scan
+        of the mask instead of sorting them."""
+        x, y = np.divmod(np.flatnonzero(mask.T), self.height)
+        return [self.position_table.position(x, y) for x, y in zip(x.tolist(), y.tolist())]
+
     def get_planted_squares(self) -> List:
         """Returns the planted squares of the environment."""
-        return self.planted_squares
+        return self.calculate_planted_squares()
 
     def add_planted_square(self, p: Position, s: Cell):
         """Adds a planted square."""
-        self.planted_squares.append((p, s))
+        self.change_cell_type(p, s)
 
     @property
     def height(self):
@@ -130,69 +303,64 @@ class Map:
         """Returns the width of the map."""
         return self.grid.shape[1]
 
-    @property
-    def all_positions(self) -> List[Position]:
-        """Returns all the positions in the map."""
-        positions = []
-        with np.nditer(self.grid, flags=["multi_index", "refs_ok"]) as it:
-            for _ in it:
-                x, y = it.multi_index
-                positions.append(Position(x=x, y=y))
-        return positions
-
-    @property
-    def possible_drone_positions(self) -> List[Position]:
-        """Returns all the positions in the map where the drone can be."""
-        return self.all_positions
+    def random_drone_position(self, rng: np.random.Generator) -> Position:
+        """Returns a position where a drone can be, drawn uniformly from the cells numbered column by column."""
+        x, y = divmod(rng.integers(self.height * self.width).item(), self.height)
+        return self.position_table.position(x, y)
 
     def is_obstacle(self, p: Position) -> bool:
         """Returns True if the position is an obstacle, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.OBSTACLE
+        return self.grid.item(p.y, p.x) == Cell.OBSTACLE.value
 
     def is_fertile_land(self, p: Position) -> bool:
         """Returns True if the position is fertile land, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.FERTILE_LAND
+        return self.grid.item(p.y, p.x) == Cell.FERTILE_LAND.value
 
     def is_initially_fertile_land(self, p: Position) -> bool:
         """Returns True if the position is fertile land, False otherwise."""
-        return self.initial_grid[p.y, p.x] == Cell.FERTILE_LAND
+        return self.initial_grid.item(p.y, p.x) == Cell.FERTILE_LAND.value
 
     def is_tree(self, p: Position) -> bool:
         """Returns True if the position is a tree, False otherwise."""
-        return self.grid[p.y, p.x] in [Cell.OAK_TREE, Cell.PINE_TREE, Cell.EUCALYPTUS_TREE]
+        return self.grid.item(p.y, p.x) in TREE_VALUES
 
     def is_oak_tree(self, p: Position) -> bool:
         """Returns True if the position is an oak tree, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.OAK_TREE
+        return self.grid.item(p.y, p.x) == Cell.OAK_TREE.value
 
     def is_pine_tree(self, p: Position) -> bool:
         """Returns True if the position is a pine tree, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.PINE_TREE
+        return self.grid.item(p.y, p.x) == Cell.PINE_TREE.value
 
     def is_eucalyptus_tree(self, p: Position) -> bool:
         """Returns True if the position is a eucalyptus tree, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.EUCALYPTUS_TREE
+        return self.grid.item(p.y, p.x) == Cell.EUCALYPTUS_TREE.value
 
     def is_charging_station(self, p: Position) -> bool:
         """Returns True if the position is a charging station, False otherwise."""
-        return self.grid[p.y, p.x] == Cell.CHARGING_STATION
+        return self.grid.item(p.y, p.x) == Cell.CHARGING_STATION.value
+
+    def get_fertile_land_added_since(self, version: int) -> list[int] | None:
+        """Returns the flat indices of the cells that became fertile land since the fertile land version, None if
+        the indexes were built again since, after which any cell may have changed."""
+        if version < self.added_fertile_land_version:
+            return None
+        return self.added_fertile_land[version - self.added_fertile_land_version:]
 
     def get_type_of_tree_that_should_be_planted(self, p: Position) -> int:
         """Returns the type of tree in the position."""
 
-        adj_positions = self.adj_positions(p)
-        adj_oak_trees = [adj for adj in adj_positions if self.is_oak_tree(adj)]
-        adj_pine_trees = [adj for adj in adj_positions if self.is_pine_tree(adj)]
-        adj_eucalyptus_trees = [adj for adj in adj_positions if self.is_eucalyptus_tree(adj)]
-
-        tree_lists = {
-            0: adj_oak_trees,
-            1: adj_pine_trees,
-            2: adj_eucalyptus_trees
-        }
-
-        # Get the length of each list
-        tree_counts = {tree_type: len(tree_list) for tree_type, tree_list in tree_lists.items()}
+        # Counts the adjacent trees of each type, read from the flat grid through the neighbour table.
+        flat_grid = self.grid.reshape(-1)
+        tree_counts = {0: 0, 1: 0, 2: 0}
+        for neighbour in self.position_table.neighbours_of(p.y * self.width + p.x):
+            code = flat_grid.item(neighbour)
+            if code == Cell.OAK_TREE.value:
+                tree_counts[0] += 1
+            elif code == Cell.PINE_TREE.value:
+                tree_counts[1] += 1
+            elif code == Cell.EUCALYPTUS_TREE.value:
+                tree_counts[2] += 1
 
         # Find the tree types with the most trees
         max_count = max(tree_counts.values())
@@ -203,85 +371,97 @@ class Map:
 
         max_trees = [tree_type for tree_type, count in tree_counts.items() if count == max_count]
         if number_of_trees_with_the_same_count > 1:
-            chosen_tree_type = random.choice(max_trees)
+            chosen_tree_type = max_trees[self.rng.integers(len(max_trees))]
         elif number_of_trees_with_the_same_count == 1:
             chosen_tree_type = max_trees[0]
         else:
-            chosen_tree_type = random.choice([0, 1, 2])
+            chosen_tree_type = int(self.rng.integers(3))
         return chosen_tree_type
 
     def get_cell_type(self, p: Position) -> Cell:
         """Returns the type of cell in the position."""
-        return self.grid[p.y, p.x]
+        return CELL_TYPES[self.grid.item(p.y, p.x)]
 
     def is_inside_map(self, p: Position) -> bool:
         """Returns True if the position is inside the map, False otherwise."""
         return 0 <= p.y < self.height and 0 <= p.x < self.width
 
-    def adj_positions(self, p: Position) -> List[Position]:
-        """Returns the adjacent positions of the position."""
-        positions = [adj for adj in p.adj if
-                     self.is_inside_map(adj)]
-        return positions
+    def position(self, x: int, y: int) -> Position:
+        """Returns the interned position of the cell (x, y), which must be inside the map."""
+        return self.position_table.position(x, y)
+
+    def position_at(self, index: int) -> Position:
+        """Returns the interned position of the cell with the flat grid index y * width + x."""
+        return self.position_table.position_at(index)
+
+    def adj_positions(self, p: Position) -> tuple[Position, ...]:
+        """Returns the adjacent positions of the position that are inside the map, in the order of Position.adj.
+        The tuple is shared, so it is not allocated again for every call."""
+        return self.position_table.adj_positions(p.y * self.width + p.x)
 
     def change_cell_type(self, p: Position, cell_type: Cell):
         """
         Modifies cell type of position p in the environment grid.
         """
-        self.grid[p.y, p.x] = cell_type
+        old_code = self.grid.item(p.y, p.x)
+        if old_code != cell_type.value:
+            self.grid[p.y, p.x] = cell_type.value
+            self.update_indexes(p, old_code, cell_type.value)
+            if self.changed_positions is not None:
+                self.changed_positions.add(p)
 
     def plantable_squares(self) -> List[Position]:
         """
         Looks at the grid and returns fertile land squares that have not yet
-        been planted. 
-        
+        been planted. Scans the whole grid, number_of_plantable_squares is the
+        constant time query.
+        """
+        return self.positions_of(self.fertile_land_mask())
+
+    def number_of_plantable_squares(self) -> int:
+        """
+        Returns the number of fertile land squares that have not yet been planted.
         """
-        plantable_positions = []
-        for p in self.all_positions:
-            if self.is_fertile_land(p):
-                plantable_positions.append(p)
-        return plantable_positions
+        return self.n_fertile_land
 
     def calculate_planted_squares(self) -> list[tuple[Position, Cell]]:
         """
         Looks at the grid and returns fertile land squares that have already
-        been planted.
-
+        been planted. Scans the whole grid, number_of_planted_squares is the
+        constant time query.
         """
-        planted_positions = []
-        for p in self.all_positions:
-            if self.is_oak_tree(p) or self.is_pine_tree(p) or self.is_eucalyptus_tree(p):
-                planted_positions.append((p, self.get_cell_type(p)))
-        return planted_positions
+        return [(p, self.get_cell_type(p)) for p in self.positions_of(self.tree_mask())]
 
     def find_charging_station(self):
         """
         Looks at the grid and returns the position of the charging station
         """
-        for p in self.all_positions:
-            if self.is_charging_station(p):
-                return p
-        return None
+        if len(self.charging_station_indices) == 0:
+            return None
+        return min((self.position_at(index) for index in self.charging_station_indices), key=scan_order)
 
     def number_of_planted_squares(self) -> int:
         """
         Returns the number of planted squares.
         """
-        number_of_planted_squares = 0
-        for p in self.all_positions:
-            if self.is_initially_fertile_land(p):
-                if self.is_oak_tree(p) or self.is_pine_tree(p) or self.is_eucalyptus_tree(p):
-                    number_of_planted_squares += 1
-        return number_of_planted_squares
+        return self.n_planted_squares
 
     def update_position(self, p: Position, cell_type: Cell):
         """
         Updates the position p in the grid to the cell type.
         """
-        self.grid[p.y, p.x] = cell_type
+        self.change_cell_type(p, cell_type)
+
+    def update_cells(self, indices: np.ndarray, codes: np.ndarray):
+        """
+        Updates many positions at once, given as flat grid indices (y * width + x), to the cell codes. The grid is
+        compared with all of them in a single fancy indexing operation and only the positions whose cell type
+        changes go through the indexes.
+        """
+        for i in np.flatnonzero(self.grid.reshape(-1)[indices] != codes):
+            self.change_cell_type(self.position_table.position_at(indices.item(i)), CELL_TYPES[codes.item(i)])
 
-    @staticmethod
-    def map_id_to_cell_type(id: int) -> Cell:
+    def map_id_to_cell_type(self, id: int) -> Cell:
         """
         Maps an id to a cell type.
         """
@@ -292,20 +472,17 @@ class Map:
         elif id == 2:
             return Cell.EUCALYPTUS_TREE
         else:
-            return random.choice([Cell.OAK_TREE, Cell.PINE_TREE, Cell.EUCALYPTUS_TREE])
+            return [Cell.OAK_TREE, Cell.PINE_TREE, Cell.EUCALYPTUS_TREE][self.rng.integers(3)]
 
     def is_unknown(self, p: Position) -> bool:
         """
         Returns True if the position is unknown, False otherwise.
         """
-        return self.grid[p.y, p.x] == Cell.UNKNOWN
+        return self.grid.item(p.y, p.x) == Cell.UNKNOWN.value
 
     def get_unknown_cells(self) -> List[Position]:
         """
-        Returns a list of unknown cells.
+        Returns a list of unknown cells. Scans the whole grid, is_unknown is
+        the constant time query of a single cell.
         """
-        unknown_cells = []
-        for p in self.all_positions:
-            if self.is_unknown(p):
-                unknown_cells.append(p)
-        return unknown_cells
+        return self.positions_of(self.unknown_mask())
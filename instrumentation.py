@@ -0,0 +1,78 @@
+import contextlib
+import time
+from collections import Counter, defaultdict
+
+
+class PhaseTimer:
+    """Context manager that adds the wall time of a phase to the current step of the instrumentation."""
+
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation: "Instrumentation", name: str):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.current_step[self.name] += time.perf_counter() - self.start
+
+
+class Instrumentation:
+    """
+    Opt-in record of where the time of a run goes: the wall time of each phase of the run loop, cumulative and per
+    step, and counters of the expensive operations, such as searches, messages, full grid scans and cells redrawn.
+    While disabled, phase returns a shared context manager that does nothing and count returns at once, so the
+    hooks cost a method call. Hooks that need work to compute what they count check enabled first.
+    """
+
+    NULL_PHASE = contextlib.nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def enable(self, enabled: bool = True):
+        """Turns the instrumentation on or off."""
+        self.enabled = enabled
+
+    def reset(self):
+        """Forgets everything recorded, e.g. at the beginning of a run."""
+        self.steps = []
+        self.current_step = defaultdict(float)
+        self.counters = Counter()
+
+    def phase(self, name: str):
+        """Returns a context manager that times a phase of the current step."""
+        return PhaseTimer(self, name) if self.enabled else self.NULL_PHASE
+
+    def count(self, name: str, n: int = 1):
+        """Adds n to a counter."""
+        if self.enabled:
+            self.counters[name] += n
+
+    def end_step(self):
+        """Closes the current step, keeping the time of each of its phases."""
+        if self.enabled:
+            self.steps.append(dict(self.current_step))
+            self.current_step = defaultdict(float)
+
+    def summary(self) -> dict:
+        """
+        Returns what was recorded since the last reset: the number of steps, the total, mean and max per step wall
+        time of each phase and the counters.
+        """
+        n_steps = len(self.steps)
+        names = sorted({name for step in self.steps for name in step})
+        phases = {}
+        for name in names:
+            times = [step.get(name, 0.0) for step in self.steps]
+            phases[name] = {"total": sum(times), "mean": sum(times) / n_steps, "max": max(times)}
+        return {"n_steps": n_steps, "phases": phases, "counters": dict(sorted(self.counters.items()))}
+
+
+# Instrumentation shared by the whole process, disabled unless a run enables it.
+INSTRUMENTATION = Instrumentation()
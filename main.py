@@ -1,20 +1,68 @@
+import argparse
 import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pygame
-import yaml
-from typing import Any
+from typing import Any, Iterator
 from drone import Drone, Action
 from env import Environment
 from agent import Agent, RandomAgent, GreedyAgent, CommunicativeAgent
-from graphical import EnvironmentPrinter
+from communication import deliver_messages
+from instrumentation import INSTRUMENTATION
+from printer import HeadlessPrinter
+from recording import MetricsWriter, StepTrace, TraceWriter
+from vector_env import VectorEnvironment, BATCHED_POLICIES
 from metrics import get_percentage_of_planted_squares, get_avg_distance_needed_to_identify_fertile_land, \
-    get_avg_energy_used_per_planted_tree
-from grid import Map
-from default import MAP
+    get_avg_energy_used_per_planted_tree, get_histograms
+from grid import Map, create_unknown_map
+from default import DefaultMap, corpus_paths, load_map
+from config import Config
 
 
-def run_graphical(map: Map, agents: list[Agent], drones: list[Drone], timestep: any) -> tuple[int, bool, bool | Any, float | Any, Any, Any]:
-    """ Runs the simulation in a graphical environment."""
+def step_simulation(environment: Environment, map: Map, agents: list[Agent], drones: list[Drone]) -> tuple[bool, bool]:
+    """ Advances the simulation by one timestep and returns the terminal and all drones dead flags."""
+    # Agents observing the environment.
+    with INSTRUMENTATION.phase("see"):
+        for agent in agents:
+            agent.see(map)
+
+    # Communicative agents receive the observations of the others before choosing.
+    with INSTRUMENTATION.phase("deliver_messages"):
+        deliver_messages(agents)
+
+    # Agents choose actions.
+    with INSTRUMENTATION.phase("choose_action"):
+        actions = [agent.choose_action() for agent in agents]
+
+    # Notifies the others agents that he is going to charge.
+    with INSTRUMENTATION.phase("notify_intention_to_charge"):
+        for agent, action in zip(agents, actions):
+            if isinstance(agent, CommunicativeAgent) and action == Action.CHARGE:
+                agent.notify_intention_to_charge(environment.get_timestep())
+        deliver_messages(agents)
+
+    with INSTRUMENTATION.phase("step"):
+        terminal = environment.step(actions, agents)
+
+    # Drones are dead if they reach 0 energy before reaching a charging station.
+    all_drones_dead = all([drone.is_drone_dead() for drone in drones])
+
+    return terminal, all_drones_dead
+
+
+def collect_metrics(map: Map, agents: list[Agent]) -> tuple[float | Any, Any, Any]:
+    """ Computes the metrics of a finished simulation."""
+    percentage_of_planted_squares = get_percentage_of_planted_squares(map)
+    avg_distance_needed_to_identify_fertile_land = get_avg_distance_needed_to_identify_fertile_land(agents)
+    avg_energy_used_per_planted_tree = get_avg_energy_used_per_planted_tree(agents)
+
+    return percentage_of_planted_squares, avg_distance_needed_to_identify_fertile_land, avg_energy_used_per_planted_tree
+
+
+def run_graphical(map: Map, agents: list[Agent], drones: list[Drone], timestep: any, trace: StepTrace = None) -> tuple[int, bool, bool | Any, float | Any, Any, Any]:
+    """ Runs the simulation in a graphical environment, recording every step in the trace if one is given."""
+    import pygame
+    from graphical import EnvironmentPrinter
+
     with EnvironmentPrinter(map.get_initial_grid()) as printer:
         # Environment variable
         environment = Environment(printer, map)
@@ -32,25 +80,14 @@ def run_graphical(map: Map, agents: list[Agent], drones: list[Drone], timestep:
                 if event.type == pygame.QUIT:
                     running = False
 
-            # Agents observing the environment.
-            for agent in agents:
-                agent.see(map)
-
-            # Agents choose actions.
-            actions = [agent.choose_action() for agent in agents]
-
-            # Notifies the others agents that he is going to charge.
-            for agent, action in zip(agents, actions):
-                if isinstance(agent, CommunicativeAgent) and action == Action.CHARGE:
-                    agent.notify_intention_to_charge(environment.get_timestep())
-
-            terminal = environment.step(actions, agents)
-
-            # Drones are dead if they reach 0 energy before reaching a charging station.
-            all_drones_dead = all([drone.is_drone_dead() for drone in drones])
+            terminal, all_drones_dead = step_simulation(environment, map, agents, drones)
 
             n_steps += 1
-            environment.render(drones)
+            if trace is not None:
+                trace.record(environment, agents)
+            with INSTRUMENTATION.phase("render"):
+                environment.render(drones)
+            INSTRUMENTATION.end_step()
 
             # Terminal conditions
             if terminal:
@@ -60,99 +97,264 @@ def run_graphical(map: Map, agents: list[Agent], drones: list[Drone], timestep:
 
             time.sleep(timestep)
 
-    # Metrics
-    percentage_of_planted_squares = get_percentage_of_planted_squares(map)
-    avg_distance_needed_to_identify_fertile_land = get_avg_distance_needed_to_identify_fertile_land(agents)
-    avg_energy_used_per_planted_tree = get_avg_energy_used_per_planted_tree(agents)
+    if trace is not None:
+        trace.flush()
+    return (n_steps, terminal, all_drones_dead) + collect_metrics(map, agents)
 
-    return n_steps, terminal, all_drones_dead, percentage_of_planted_squares, avg_distance_needed_to_identify_fertile_land, avg_energy_used_per_planted_tree
-
-
-def main():
-    with open("./config.yml", "r") as fp:
-        data = yaml.safe_load(fp)
-
-    # Parameters from config file
-    max_number_of_seeds = data["max_number_of_seeds"]
-    max_battery_capacity = data["max_battery_capacity"]
-    num_agents = data[data["agent_type"]]["nr_agents"]
-    n_runs = data["n_runs"]
-
-    if max_number_of_seeds < 5:
-        raise ValueError("Max number of seeds inserted in the config file must be greater than 5 inclusive.")
-    if max_battery_capacity < 2 * data["map_size"]:
-        raise ValueError("Max battery capacity inserted in the config file must be greater than 2 * map_size.")
-    if n_runs <= 0:
-        raise ValueError("Number of runs inserted in the config file must be greater than 0.")
-    timestep = data["timestep"]
-    if timestep < 0:
-        raise ValueError("Timestep inserted in the config file must be greater than 0 inclusive.")
-
-    # Variables to store metrics
-    all_n_steps = []
-    number_of_dead_drones = []
-    percentage_of_planted_trees = []
-    avg_energy_used = []
-    avg_distance_needed_to_identify_fertile_land = []
-    avg_drone_distance = []
-
-    # Environment map
-    map = Map(MAP)
-
-    # Agents
-    drones = []
-    if data["agent_type"] == "RandomAgent":
-        agents = [RandomAgent(i, max_number_of_seeds, max_battery_capacity, map) for i in range(num_agents)]
-    elif data["agent_type"] == "GreedyAgent":
-        agents = [GreedyAgent(i, max_number_of_seeds, max_battery_capacity, map) for i in range(num_agents)]
-    elif data["agent_type"] == "CommunicativeAgent":
-        agents = [CommunicativeAgent(i, max_number_of_seeds, max_battery_capacity, map) for i in range(num_agents)]
-    else:
-        raise Exception("Agent type not recognized")
 
-    # Main loop
-    for _ in range(n_runs):
+def run_headless(map: Map, agents: list[Agent], drones: list[Drone], trace: StepTrace = None) -> tuple[int, bool, bool | Any, float | Any, Any, Any]:
+    """ Runs the simulation without a graphical environment, recording every step in the trace if one is given."""
+    environment = Environment(HeadlessPrinter(), map)
 
-        # Create drones
-        for agent in agents:
-            if isinstance(agent, CommunicativeAgent):
-                agent.set_agents(agents)
-            drones.append(agent.get_drone())
-
-        # Run simulation
-        n_steps, terminal, all_drones_dead, percentage_of_planted_squares, avg_distance_needed_to_fertile_land, avg_energy_used_per_planted_tree = \
-            run_graphical(map, agents, drones, timestep)
-
-        # Metrics
-        avg_drone_distance.append(np.mean([drone.total_distance for drone in drones]))
-        all_n_steps.append(n_steps)
-        number_of_dead_drones.append(len([drone for drone in drones if drone.is_drone_dead]))
-        percentage_of_planted_trees.append(percentage_of_planted_squares)
-        avg_distance_needed_to_identify_fertile_land.append(avg_distance_needed_to_fertile_land)
-        avg_energy_used.append(avg_energy_used_per_planted_tree)
-
-        # Reset environment and agents for next run
-        for agent in agents:
-            agent.reset()
-        map.reset()
-        drones = []
+    terminal = False
+    all_drones_dead = False
+    n_steps = 0
 
-        # Terminal conditions for a run
-        if all_drones_dead:
-            continue
+    while True:
+        terminal, all_drones_dead = step_simulation(environment, map, agents, drones)
+
+        n_steps += 1
+        if trace is not None:
+            trace.record(environment, agents)
+        INSTRUMENTATION.end_step()
+
+        # Terminal conditions
         if terminal:
             break
+        if all_drones_dead:
+            break
+
+    if trace is not None:
+        trace.flush()
+    return (n_steps, terminal, all_drones_dead) + collect_metrics(map, agents)
+
+
+def create_agents(config: Config, map: Map, seed_sequences: list[np.random.SeedSequence] = None) -> list[Agent]:
+    """ Creates the agents of the configured type on the given map. When seed sequences are given, each agent
+    draws its random numbers from the generator of its own sequence."""
+    if config.agent_type == "RandomAgent":
+        agent_class = RandomAgent
+    elif config.agent_type == "GreedyAgent":
+        agent_class = GreedyAgent
+    elif config.agent_type == "CommunicativeAgent":
+        agent_class = CommunicativeAgent
+    else:
+        raise Exception("Agent type not recognized")
+    # The drones of a blackboard fleet read and write the same map, created once for all of them.
+    known_map = None
+    if agent_class is CommunicativeAgent and config.map_sharing == "blackboard":
+        known_map = create_unknown_map(map.height, map.width)
+    return [agent_class(i, config.max_number_of_seeds, config.max_battery_capacity, map, config,
+                        np.random.default_rng(seed_sequences[i]) if seed_sequences is not None else None, known_map)
+            for i in range(config.get_num_agents())]
+
+
+def spawn_seed_sequences(config: Config) -> tuple[np.random.SeedSequence, list[np.random.SeedSequence]]:
+    """ Spawns from the seed in the config the seed sequence of the generated map and one per run. Their streams
+    are independent, so a run draws the same numbers whether it runs in sequence or in a worker process."""
+    map_sequence, *run_sequences = np.random.SeedSequence(config.seed).spawn(config.n_runs + 1)
+    return map_sequence, run_sequences
+
+
+def create_run(grid: np.ndarray | str, config: Config, seed_sequence: np.random.SeedSequence) -> tuple[Map, list[Agent], list[Drone]]:
+    """ Creates the map, agents and drones of a run. The map is either a grid or the path of a .npy map, which is
+    memory mapped. The map and every agent get their own child stream of the seed sequence of the run."""
+    map_sequence, *agent_sequences = seed_sequence.spawn(config.get_num_agents() + 1)
+    map = Map(load_map(grid), np.random.default_rng(map_sequence))
+    agents = create_agents(config, map, agent_sequences)
+
+    drones = []
+    for agent in agents:
+        if isinstance(agent, CommunicativeAgent):
+            agent.set_agents(agents)
+        drones.append(agent.get_drone())
+    return map, agents, drones
+
+
+def get_run_metrics(results: tuple, drones: list[Drone]) -> tuple:
+    """ Returns the row of the metrics file for a finished run."""
+    n_steps, terminal, all_drones_dead, percentage_of_planted_squares, avg_distance_needed_to_fertile_land, avg_energy_used_per_planted_tree = \
+        results
+    number_of_dead_drones = len([drone for drone in drones if drone.is_drone_dead()])
+    avg_drone_distance = np.mean([drone.total_distance for drone in drones])
+
+    return avg_energy_used_per_planted_tree, avg_distance_needed_to_fertile_land, percentage_of_planted_squares, \
+        number_of_dead_drones, avg_drone_distance, n_steps
+
+
+def get_trace_directory(config: Config) -> str:
+    """ Returns the directory where the traces of the runs are saved."""
+    return f"trace-{config.agent_type}-agents-{config.get_num_agents()}"
+
+
+def run_episode(grid: np.ndarray | str, config: Config, seed_sequence: np.random.SeedSequence, run: int = 0) -> tuple:
+    """ Runs a single headless simulation with its own map and agents and returns its metrics row, along with the
+    summary of its instrumentation and its histograms, each of them None unless it is enabled in the config.
+    When tracing is enabled, the trace of the run is saved as the given run."""
+    map, agents, drones = create_run(grid, config, seed_sequence)
+    INSTRUMENTATION.enable(config.instrumentation)
+    INSTRUMENTATION.reset()
+    if config.trace:
+        with TraceWriter(get_trace_directory(config)) as writer:
+            results = run_headless(map, agents, drones, StepTrace(writer, run, len(drones), config.trace_chunk_size))
+    else:
+        results = run_headless(map, agents, drones)
+    return get_run_metrics(results, drones), INSTRUMENTATION.summary() if config.instrumentation else None, \
+        get_histograms(agents)
+
+
+def run_parallel(maps: list[np.ndarray | str], config: Config, run_sequences: list[np.random.SeedSequence]) -> Iterator[tuple]:
+    """ Runs independent headless simulations across a pool of worker processes, cycling through the maps.
+    Yields the (row, instrumentation summary, histograms) of every run in order, as soon as it and the runs before finish,
+    see run_episode."""
+    with ProcessPoolExecutor(max_workers=config.n_workers) as executor:
+        futures = [executor.submit(run_episode, maps[run % len(maps)], config, run_sequences[run], run)
+                   for run in range(config.n_runs)]
+        for future in futures:
+            yield future.result()
+
+
+def run_vectorized(maps: list[np.ndarray | str], config: Config, seed_sequence: np.random.SeedSequence) -> Iterator[tuple]:
+    """ Runs the simulations in batches of episodes that are stepped together by a vectorized environment.
+    Each slot of the batch keeps one of the maps, cycling through them. Since the episodes are stepped together,
+    they draw from the single stream of the seed sequence. Yields the metrics rows as the episodes finish."""
+    batch_size = min(config.batch_size, config.n_runs)
+    grids = np.stack([load_map(maps[slot % len(maps)]) for slot in range(batch_size)])
+    environment = VectorEnvironment(grids, config.get_num_agents(), config.max_number_of_seeds,
+                                    config.max_battery_capacity, np.random.default_rng(seed_sequence))
+    return environment.episodes(BATCHED_POLICIES[config.agent_type](environment), config.n_runs)
+
+
+def write_profile(agent_type: str, num_agents: int, summaries: list[dict]) -> None:
+    """ Writes the instrumentation of every run to the profile file: the total, mean per step and max per step wall
+    time in seconds of each phase, followed by the total and mean per step of each counter."""
+    with open(f"profile-{agent_type}-agents-{num_agents}.csv", "w") as profile:
+        profile.write("Run, Name, Total, Mean per step, Max per step\n")
+        for run, summary in enumerate(summaries):
+            for name, phase in summary["phases"].items():
+                profile.write(f"{run}, {name}, {phase['total']}, {phase['mean']}, {phase['max']}\n")
+            for name, total in summary["counters"].items():
+                profile.write(f"{run}, {name}, {total}, {total / max(summary['n_steps'], 1)}, \n")
+
+
+def write_histograms(agent_type: str, num_agents: int, histograms: list[dict], n_bins: int) -> None:
+    """ Writes the histograms of every run to the histograms file, one line per run and metric with the number of
+    values in each bin, the last bin counting the values greater or equal than it."""
+    with open(f"histograms-{agent_type}-agents-{num_agents}.csv", "w") as file:
+        file.write(", ".join(["Run", "Metric"] + [f"Bin {i}" for i in range(n_bins)]) + "\n")
+        for run, run_histograms in enumerate(histograms):
+            for name, histogram in run_histograms.items():
+                file.write(", ".join([str(run), name] + [str(count) for count in histogram.tolist()]) + "\n")
+
+
+def get_maps(config: Config, seed_sequence: np.random.SeedSequence) -> list[np.ndarray | str]:
+    """ Returns the paths of the maps of the corpus in the config, or a single map generated from the config,
+    seeded with map_seed when it is set and with the seed sequence otherwise."""
+    if config.map_corpus is None:
+        return [DefaultMap(config, config.map_seed if config.map_seed is not None else seed_sequence).MAP]
+
+    paths = corpus_paths(config.map_corpus)
+    for path in paths:
+        if load_map(path).shape != (config.map_size, config.map_size):
+            raise ValueError(f"Maps of the corpus inserted in the config file must have map_size, {path} does not.")
+    return paths
+
+
+def main(config_path: str = "./config.yml", headless: bool = None, n_workers: int = None, batch_size: int = None,
+         instrumentation: bool = None, trace: bool = None):
+    # The config file is read once, the command line flags take precedence over it.
+    config = Config.load(config_path, headless=headless, n_workers=n_workers, batch_size=batch_size,
+                         instrumentation=instrumentation, trace=trace)
+    num_agents = config.get_num_agents()
+
+    # All the randomness comes from the seed in the config
+    map_sequence, run_sequences = spawn_seed_sequences(config)
+
+    # Maps of the runs, generated or from the corpus
+    maps = get_maps(config, map_sequence)
+
+    # Metrics are written to the file as the runs finish
+    with MetricsWriter(config.agent_type, num_agents) as metrics:
+
+        # Runs are stepped together in batches by a vectorized environment, always without the graphical interface.
+        if config.batch_size > 0:
+            for row in run_vectorized(maps, config, run_sequences[0]):
+                metrics.write(row)
+            return
+
+        # Independent runs are spread across worker processes, always without the graphical interface.
+        if config.n_workers > 1:
+            summaries = []
+            histograms = []
+            for row, summary, run_histograms in run_parallel(maps, config, run_sequences):
+                metrics.write(row)
+                summaries.append(summary)
+                histograms.append(run_histograms)
+            if config.instrumentation:
+                write_profile(config.agent_type, num_agents, summaries)
+            if config.histogram_bins > 0:
+                write_histograms(config.agent_type, num_agents, histograms, config.histogram_bins)
+            return
+
+        # Variables to store the instrumentation and the histograms of the runs
+        summaries = []
+        histograms = []
+        INSTRUMENTATION.enable(config.instrumentation)
+        writer = TraceWriter(get_trace_directory(config)) if config.trace else None
+
+        try:
+            # Main loop
+            for run in range(config.n_runs):
+
+                # Environment map, agents and drones of the run, with the next map of a corpus
+                map, agents, drones = create_run(maps[run % len(maps)], config, run_sequences[run])
+                INSTRUMENTATION.reset()
+                trace = StepTrace(writer, run, len(drones), config.trace_chunk_size) if writer is not None else None
+
+                # Run simulation
+                if config.is_graphical():
+                    results = run_graphical(map, agents, drones, config.timestep, trace)
+                else:
+                    results = run_headless(map, agents, drones, trace)
+                _, terminal, all_drones_dead, _, _, _ = results
+
+                # Metrics
+                metrics.write(get_run_metrics(results, drones))
+                if config.instrumentation:
+                    summaries.append(INSTRUMENTATION.summary())
+                if config.histogram_bins > 0:
+                    histograms.append(get_histograms(agents))
+
+                # Terminal conditions for a run
+                if all_drones_dead:
+                    continue
+                if terminal:
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
 
-    # Write metrics to file
-    with open(f"metrics-{data['agent_type']}-agents-{num_agents}.csv", "w") as metrics:
-        metrics.write(
-            "Average energy used per planted tree, Average distance to identify fertile land, Percentage of planted squares, Number of drones that died, Drones average distance traveled, Number of steps to complete the map\n")
-        for a, b, c, d, e, f in zip(avg_energy_used, avg_distance_needed_to_identify_fertile_land,
-                                    percentage_of_planted_trees,
-                                    number_of_dead_drones, avg_drone_distance, all_n_steps):
-            metrics.write(f"{a}, {b}, {c}, {d}, {e}, {f}\n")
+    if config.instrumentation:
+        write_profile(config.agent_type, num_agents, summaries)
+    if config.histogram_bins > 0:
+        write_histograms(config.agent_type, num_agents, histograms, config.histogram_bins)
 
 
 # Run main
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Runs the drone planting simulation.")
+    parser.add_argument("--config", default="./config.yml",
+                        help="Path of the config file.")
+    parser.add_argument("--headless", action="store_true", default=None,
+                        help="Runs the simulation without the graphical interface.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes used to run the simulations in parallel.")
+    parser.add_argument("--batch-size", type=int, default=None,
+                        help="Number of runs stepped together by the vectorized environment, 0 disables it.")
+    parser.add_argument("--instrument", action="store_true", default=None,
+                        help="Writes the time of each phase and counters of every run to a profile file.")
+    parser.add_argument("--trace", action="store_true", default=None,
+                        help="Saves a trace of every step of the runs to .npz files.")
+    args = parser.parse_args()
+    main(config_path=args.config, headless=args.headless, n_workers=args.workers, batch_size=args.batch_size,
+         instrumentation=args.instrument, trace=args.trace)
@@ -5,12 +5,61 @@ import numpy as np
 """ Metrics to be used for the analysis of the simulation results. """
 
 
+class RunningStatistic:
+    """
+    Running count, sum and sum of squares of the values of a metric, so its mean and variance are read in constant
+    time and its memory does not grow with the number of values. With n_bins > 0 it also keeps a histogram of the
+    values, one bin per integer value from 0, the last bin counting every value greater or equal than it.
+    """
+
+    def __init__(self, n_bins: int = 0):
+        self.count = 0
+        self.sum = 0
+        self.sum_of_squares = 0
+        self.histogram = np.zeros(n_bins, dtype=np.int64) if n_bins > 0 else None
+
+    def add(self, value: int):
+        """Adds a value of the metric."""
+        self.count += 1
+        self.sum += value
+        self.sum_of_squares += value * value
+        if self.histogram is not None:
+            self.histogram[min(max(value, 0), len(self.histogram) - 1)] += 1
+
+    def get_count(self) -> int:
+        """Returns the number of values."""
+        return self.count
+
+    def get_sum(self) -> int:
+        """Returns the sum of the values."""
+        return self.sum
+
+    def get_sum_of_squares(self) -> int:
+        """Returns the sum of the squares of the values."""
+        return self.sum_of_squares
+
+    def get_mean(self) -> float:
+        """Returns the mean of the values, nan without values."""
+        return self.sum / self.count if self.count != 0 else np.nan
+
+    def get_variance(self) -> float:
+        """Returns the population variance of the values, nan without values."""
+        if self.count == 0:
+            return np.nan
+        mean = self.sum / self.count
+        return max(self.sum_of_squares / self.count - mean * mean, 0.0)
+
+    def get_histogram(self) -> np.ndarray:
+        """Returns the histogram of the values, None unless it was created with bins."""
+        return self.histogram
+
+
 def get_avg_distance_needed_to_identify_fertile_land(agents: list[Agent]):
     distances = []
     for agent in agents:
         drone = agent.get_drone()
-        if len(drone.distance_needed_to_identify_fertile_land) != 0:
-            distances.append(np.mean(drone.distance_needed_to_identify_fertile_land))
+        if drone.distance_needed_to_identify_fertile_land.get_count() != 0:
+            distances.append(drone.distance_needed_to_identify_fertile_land.get_mean())
     return np.mean(distances)
 
 
@@ -23,5 +72,34 @@ def get_avg_energy_used_per_planted_tree(agents: list[Agent]):
     return np.mean(distances)
 
 
+def sum_histograms(statistics: list[RunningStatistic]):
+    """Returns the sum of the histograms of the statistics, None if they do not keep histograms."""
+    histograms = [statistic.get_histogram() for statistic in statistics]
+    if len(histograms) == 0 or histograms[0] is None:
+        return None
+    return np.sum(histograms, axis=0)
+
+
+def get_histogram_of_distance_needed_to_identify_fertile_land(agents: list[Agent]):
+    """Returns the histogram of the distances to identify fertile land of all the drones, None without histograms."""
+    return sum_histograms([agent.get_drone().distance_needed_to_identify_fertile_land for agent in agents])
+
+
+def get_histogram_of_energy_used_per_planted_tree(agents: list[Agent]):
+    """Returns the histogram of the energy used per planted tree of all the drones, None without histograms."""
+    return sum_histograms([agent.get_drone().energy_per_planted_tree for agent in agents])
+
+
+def get_histograms(agents: list[Agent]) -> dict | None:
+    """Returns the histograms of a finished run by metric, None if the drones do not keep histograms."""
+    distances = get_histogram_of_distance_needed_to_identify_fertile_land(agents)
+    if distances is None:
+        return None
+    return {
+        "Distance to identify fertile land": distances,
+        "Energy used per planted tree": get_histogram_of_energy_used_per_planted_tree(agents),
+    }
+
+
 def get_percentage_of_planted_squares(map: Map):
     return map.number_of_planted_squares() / map.get_initial_number_of_plantable_squares()
@@ -0,0 +1,272 @@
+import abc
+import functools
+import heapq
+import weakref
+import numpy as np
+from collections import deque
+from grid import Map, Position, NEIGHBOUR_OFFSETS
+from instrumentation import INSTRUMENTATION
+
+# Cost of a move to one of the 4 orthogonally adjacent cells and to one of the 4 diagonally adjacent cells.
+MOVE_COST = 1
+DIAGONAL_MOVE_COST = 1
+
+# Distance of the cells from which the target cannot be reached.
+UNREACHABLE = np.iinfo(np.int32).max
+
+
+def octile_distance(source: Position, target: Position) -> int:
+    """Returns the octile distance between two positions, with the cost of orthogonal and diagonal moves."""
+    dx = abs(target.x - source.x)
+    dy = abs(target.y - source.y)
+    return MOVE_COST * (dx + dy) + (DIAGONAL_MOVE_COST - 2 * MOVE_COST) * min(dx, dy)
+
+
+def chebyshev_distance_field(height: int, width: int, target_x: int, target_y: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Computes the distance of every cell of a height x width grid to the target and the next hop towards it,
+    when every cell can be crossed. The next hop moves diagonally towards the target until it is aligned with it.
+    Returns the distances and the x and y steps of the next hop, indexed by [y, x]. Distances and next hops of
+    single cells are computed in closed form by ChebyshevPathFinder, so the fields are not cached.
+    """
+    ys, xs = np.indices((height, width), dtype=np.int32)
+    step_x = np.sign(target_x - xs).astype(np.int8)
+    step_y = np.sign(target_y - ys).astype(np.int8)
+    distances = np.maximum(np.abs(target_x - xs), np.abs(target_y - ys))
+    return distances, step_x, step_y
+
+
+def breadth_first_search(map: Map, source: Position, target: Position, passable: np.ndarray = None) -> list[Position] | None:
+    """Computes the list of positions in the path from source to target.
+    It uses a BFS so the path is the shortest path."""
+    targets = np.zeros((map.height, map.width), dtype=bool)
+    targets[target.y, target.x] = True
+    return nearest_square_search(map, source, targets, passable)
+
+
+def nearest_square_search(map: Map, source: Position, targets: np.ndarray, passable: np.ndarray = None) -> list[Position] | None:
+    """Computes the list of positions in the path from source to the nearest position of the map marked in the
+    targets mask, or None if no target can be reached.
+    It uses a single BFS bounded to the map that stops at the first target reached, so the path is the shortest
+    path. Cells are visited as flat indices, with the parent of each cell kept in an array and the neighbours read
+    from the neighbour table of the map, and the path is only built once a target is reached. When a passable mask
+    is given, the search only goes through those cells, although targets are always reached."""
+    height, width = map.height, map.width
+    neighbours_of = map.position_table.neighbours_of
+    flat_targets = targets.ravel()
+    flat_passable = passable.ravel() if passable is not None else None
+
+    # -1 marks the cells that were not visited yet.
+    parents = np.full(height * width, -1, dtype=np.int64)
+    source_index = source.y * width + source.x
+    parents[source_index] = source_index
+
+    INSTRUMENTATION.count("bfs_calls")
+    queue = deque([source_index])
+    n_expanded = 0
+    while len(queue) > 0:
+        curr = queue.popleft()
+        n_expanded += 1
+
+        if flat_targets.item(curr):
+            INSTRUMENTATION.count("bfs_nodes_expanded", n_expanded)
+            path = [curr]
+            while curr != source_index:
+                curr = parents.item(curr)
+                path.append(curr)
+            return [map.position_at(index) for index in reversed(path)]
+
+        for neighbour in neighbours_of(curr):
+            if parents.item(neighbour) == -1:
+                if flat_passable is not None and not flat_passable.item(neighbour) \
+                        and not flat_targets.item(neighbour):
+                    continue
+                parents[neighbour] = curr
+                queue.append(neighbour)
+    INSTRUMENTATION.count("bfs_nodes_expanded", n_expanded)
+    return None
+
+
+class PathFinder(abc.ABC):
+    """Abstract base class for all path finding engines."""
+
+    @abc.abstractmethod
+    def shortest_path(self, map: Map, source: Position, target: Position) -> list[Position] | None:
+        """Returns the positions in the shortest path from source to target, both included,
+        or None if the target cannot be reached."""
+        pass
+
+    @abc.abstractmethod
+    def nearest_path(self, map: Map, source: Position, targets: np.ndarray) -> list[Position] | None:
+        """Returns the positions in the shortest path from source to the nearest position marked in the targets
+        mask, both included, or None if no target can be reached."""
+        pass
+
+    @abc.abstractmethod
+    def distance_field(self, map: Map, target: Position) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the distance of every cell to the target and the x and y steps of the next hop towards it,
+        indexed by [y, x]. Meant to be cached for targets queried from many positions, such as charging stations."""
+        pass
+
+    def distance(self, map: Map, source: Position, target: Position) -> int:
+        """Returns the number of moves from source to target, looked up in the distance field of the target."""
+        distances, _, _ = self.distance_field(map, target)
+        return distances.item(source.y, source.x)
+
+    def next_position(self, map: Map, source: Position, target: Position) -> Position:
+        """Returns the position to move to from source to get closer to the target, looked up in the distance
+        field of the target. It is the source itself if the target cannot be reached."""
+        _, step_x, step_y = self.distance_field(map, target)
+        return map.position(source.x + step_x.item(source.y, source.x), source.y + step_y.item(source.y, source.x))
+
+
+class ChebyshevPathFinder(PathFinder):
+    """
+    Path finding in closed form for drones that move to any of the 8 adjacent cells with unit cost and fly over
+    every cell, where the shortest path length is the Chebyshev distance.
+    """
+
+    def shortest_path(self, map: Map, source: Position, target: Position) -> list[Position] | None:
+        path = [source]
+        curr = source
+        while curr != target:
+            step_x = (target.x > curr.x) - (target.x < curr.x)
+            step_y = (target.y > curr.y) - (target.y < curr.y)
+            curr = map.position(curr.x + step_x, curr.y + step_y)
+            path.append(curr)
+        return path
+
+    def nearest_path(self, map: Map, source: Position, targets: np.ndarray) -> list[Position] | None:
+        INSTRUMENTATION.count("full_grid_scans")
+        target_ys, target_xs = np.nonzero(targets)
+        if len(target_xs) == 0:
+            return None
+        distances = np.maximum(np.abs(target_xs - source.x), np.abs(target_ys - source.y))
+        nearest = np.argmin(distances)
+        return self.shortest_path(map, source, map.position(int(target_xs[nearest]), int(target_ys[nearest])))
+
+    def distance(self, map: Map, source: Position, target: Position) -> int:
+        return max(abs(target.x - source.x), abs(target.y - source.y))
+
+    def next_position(self, map: Map, source: Position, target: Position) -> Position:
+        step_x = (target.x > source.x) - (target.x < source.x)
+        step_y = (target.y > source.y) - (target.y < source.y)
+        return map.position(source.x + step_x, source.y + step_y)
+
+    def distance_field(self, map: Map, target: Position) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return chebyshev_distance_field(map.height, map.width, target.x, target.y)
+
+
+class AStarPathFinder(PathFinder):
+    """
+    Path finding that goes around obstacles. Single paths are found with A* and an octile heuristic, nearest
+    squares with a BFS and distance fields with a BFS from the target. Unknown cells are assumed to be crossable.
+    Distance fields are cached per map and target until an obstacle of the map changes.
+    """
+
+    def __init__(self):
+        self.fields = weakref.WeakKeyDictionary()
+
+    @staticmethod
+    def passable(map: Map) -> np.ndarray:
+        """Returns a boolean mask of the cells that can be crossed."""
+        return ~map.obstacle_mask()
+
+    def shortest_path(self, map: Map, source: Position, target: Position) -> list[Position] | None:
+        height, width = map.height, map.width
+        passable = self.passable(map).ravel()
+        source_index = source.y * width + source.x
+        target_index = target.y * width + target.x
+
+        costs = np.full(height * width, UNREACHABLE, dtype=np.int64)
+        parents = np.full(height * width, -1, dtype=np.int64)
+        costs[source_index] = 0
+        parents[source_index] = source_index
+
+        # Entries are (estimated total cost, insertion order, cell index), the insertion order breaks ties.
+        INSTRUMENTATION.count("astar_calls")
+        queue = [(octile_distance(source, target), 0, source_index)]
+        n_pushed = 1
+        while len(queue) > 0:
+            _, _, curr = heapq.heappop(queue)
+
+            if curr == target_index:
+                INSTRUMENTATION.count("astar_nodes_expanded", n_pushed - len(queue))
+                path = [curr]
+                while curr != source_index:
+                    curr = parents.item(curr)
+                    path.append(curr)
+                return [map.position_at(index) for index in reversed(path)]
+
+            y, x = divmod(curr, width)
+            for dx, dy in NEIGHBOUR_OFFSETS:
+                neighbour_x = x + dx
+                neighbour_y = y + dy
+                if 0 <= neighbour_x < width and 0 <= neighbour_y < height:
+                    neighbour = neighbour_y * width + neighbour_x
+                    if not passable.item(neighbour) and neighbour != target_index:
+                        continue
+                    cost = costs.item(curr) + (MOVE_COST if dx == 0 or dy == 0 else DIAGONAL_MOVE_COST)
+                    if cost < costs.item(neighbour):
+                        costs[neighbour] = cost
+                        parents[neighbour] = curr
+                        estimate = cost + octile_distance(map.position_at(neighbour), target)
+                        heapq.heappush(queue, (estimate, n_pushed, neighbour))
+                        n_pushed += 1
+        INSTRUMENTATION.count("astar_nodes_expanded", n_pushed)
+        return None
+
+    def nearest_path(self, map: Map, source: Position, targets: np.ndarray) -> list[Position] | None:
+        return nearest_square_search(map, source, targets, self.passable(map))
+
+    def distance_field(self, map: Map, target: Position) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        key = (target, map.obstacles_version)
+        cached = self.fields.get(map)
+        if cached is None or cached[0] != key:
+            cached = (key, self.compute_distance_field(map, target))
+            self.fields[map] = cached
+        return cached[1]
+
+    def compute_distance_field(self, map: Map, target: Position) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Computes the distance field of the target with a BFS from it. Obstacles get a distance, so a drone
+        on one can still leave it, but the search does not go through them."""
+        height, width = map.height, map.width
+        passable = self.passable(map)
+        distances = np.full((height, width), UNREACHABLE, dtype=np.int32)
+        step_x = np.zeros((height, width), dtype=np.int8)
+        step_y = np.zeros((height, width), dtype=np.int8)
+        distances[target.y, target.x] = 0
+
+        INSTRUMENTATION.count("bfs_calls")
+        queue = deque([(target.x, target.y)])
+        n_expanded = 0
+        while len(queue) > 0:
+            x, y = queue.popleft()
+            n_expanded += 1
+            distance = distances.item(y, x)
+            for dx, dy in NEIGHBOUR_OFFSETS:
+                neighbour_x = x + dx
+                neighbour_y = y + dy
+                if 0 <= neighbour_x < width and 0 <= neighbour_y < height \
+                        and distances.item(neighbour_y, neighbour_x) == UNREACHABLE:
+                    distances[neighbour_y, neighbour_x] = distance + 1
+                    step_x[neighbour_y, neighbour_x] = -dx
+                    step_y[neighbour_y, neighbour_x] = -dy
+                    if passable.item(neighbour_y, neighbour_x):
+                        queue.append((neighbour_x, neighbour_y))
+        INSTRUMENTATION.count("bfs_nodes_expanded", n_expanded)
+        return distances, step_x, step_y
+
+
+PATH_FINDERS = {
+    "chebyshev": ChebyshevPathFinder,
+    "astar": AStarPathFinder,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_path_finder(name: str) -> PathFinder:
+    """Returns the shared path finding engine with the given name."""
+    if name not in PATH_FINDERS:
+        raise ValueError(f"Path finding inserted in the config file must be one of {', '.join(PATH_FINDERS)}.")
+    return PATH_FINDERS[name]()
@@ -0,0 +1,14 @@
+import abc
+
+
+class Printer(abc.ABC):
+    """Abstract base class for all printers."""
+    @abc.abstractmethod
+    def print(self, env, drones) -> None:
+        pass
+
+
+class HeadlessPrinter(Printer):
+    """Printer that draws nothing, used to run the simulation without a display."""
+    def print(self, env, drones) -> None:
+        pass
@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+import numpy as np
+from communication import get_buses
+
+""" Output of the simulation results: the metrics file, written as the runs finish, and the per step traces. """
+
+# Columns of the metrics file, one row per run.
+METRICS_HEADER = "Average energy used per planted tree, Average distance to identify fertile land, Percentage of planted squares, Number of drones that died, Drones average distance traveled, Number of steps to complete the map"
+
+
+class MetricsWriter:
+    """
+    Writes the metrics file one row at a time. Every row is flushed as soon as its run finishes, so the rows of the
+    finished runs are kept if the simulation stops before the end.
+    """
+
+    def __init__(self, agent_type: str, num_agents: int):
+        self.path = f"metrics-{agent_type}-agents-{num_agents}.csv"
+        self.file = None
+
+    def __enter__(self) -> "MetricsWriter":
+        self.file = open(self.path, "w")
+        self.file.write(METRICS_HEADER + "\n")
+        self.file.flush()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def write(self, row: tuple):
+        """Writes the metrics row of a finished run."""
+        self.file.write(", ".join(str(value) for value in row) + "\n")
+        self.file.flush()
+
+
+class TraceWriter:
+    """
+    Background thread that saves the chunks of the traces to .npz files, so writing them does not stall the
+    simulation. At most max_pending chunks wait to be written, after that submit blocks until one is saved.
+    """
+
+    def __init__(self, directory: str, max_pending: int = 8):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.write_chunks, daemon=True)
+        self.thread.start()
+
+    def __enter__(self) -> "TraceWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, name: str, arrays: dict):
+        """Queues the arrays to be saved in the file name.npz of the directory. The arrays must not be modified after."""
+        self.queue.put((name, arrays))
+
+    def write_chunks(self):
+        """Saves the queued chunks until close."""
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                return
+            name, arrays = chunk
+            try:
+                np.savez(os.path.join(self.directory, name + ".npz"), **arrays)
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        """Waits for the queued chunks to be saved. Raises the first error raised while saving them."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class StepTrace:
+    """
+    Time series of a run with one entry per step: the timestep, the number of planted squares, the number of drones
+    alive, the battery of each drone and the number of messages published. Entries are buffered in preallocated
+    arrays of chunk_size steps and every full chunk is handed to the writer, as run-<run>-chunk-<chunk>.npz.
+    """
+
+    def __init__(self, writer: TraceWriter, run: int, n_drones: int, chunk_size: int = 1024):
+        self.writer = writer
+        self.run = run
+        self.n_drones = n_drones
+        self.chunk_size = chunk_size
+        self.n_chunks = 0
+        self.n_published = 0
+        self.allocate()
+
+    def allocate(self):
+        """Allocates the arrays of the next chunk."""
+        self.n_steps = 0
+        self.timestep = np.zeros(self.chunk_size, dtype=np.int64)
+        self.planted_squares = np.zeros(self.chunk_size, dtype=np.int64)
+        self.drones_alive = np.zeros(self.chunk_size, dtype=np.int64)
+        self.battery = np.zeros((self.chunk_size, self.n_drones), dtype=np.int64)
+        self.messages = np.zeros(self.chunk_size, dtype=np.int64)
+
+    def record(self, environment, agents: list):
+        """Records the state of the environment at the end of a step."""
+        fleet = environment.get_fleet(agents)
+        n_published = sum(bus.get_number_of_published_messages() for bus in get_buses(agents))
+
+        step = self.n_steps
+        self.timestep[step] = environment.get_timestep()
+        self.planted_squares[step] = environment.get_map().number_of_planted_squares()
+        self.drones_alive[step] = len(fleet) - np.count_nonzero(fleet.dead)
+        self.battery[step] = fleet.battery
+        self.messages[step] = n_published - self.n_published
+        self.n_published = n_published
+
+        self.n_steps += 1
+        if self.n_steps == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Hands the steps recorded since the last chunk to the writer."""
+        if self.n_steps == 0:
+            return
+        n_steps = self.n_steps
+        self.writer.submit(f"run-{self.run:05d}-chunk-{self.n_chunks:05d}", {
+            "timestep": self.timestep[:n_steps],
+            "planted_squares": self.planted_squares[:n_steps],
+            "drones_alive": self.drones_alive[:n_steps],
+            "battery": self.battery[:n_steps],
+            "messages": self.messages[:n_steps],
+        })
+        self.n_chunks += 1
+        self.allocate()
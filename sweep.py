@@ -0,0 +1,180 @@
+import argparse
+import dataclasses
+import glob
+import hashlib
+import itertools
+import json
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import yaml
+from config import Config
+from default import corpus_paths
+from main import get_maps, run_episode, run_vectorized, spawn_seed_sequences
+from recording import METRICS_HEADER
+
+# Directory of the modules of the simulation, whose sources version the cached results.
+MODULE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Columns of the metrics rows, averaged over the runs of every job in the aggregated table.
+METRICS = METRICS_HEADER.split(", ")
+
+
+def expand_jobs(base: Config, grid: dict, seeds: list[int]) -> list[tuple[dict, Config]]:
+    """
+    Expands the parameter grid into one job per combination of values and seed, in the order of the grid. Returns
+    the parameters of every job along with its config, the base config with the parameters set. nr_agents sets
+    the number of agents of the agent type of the job.
+    """
+    names = list(grid)
+    jobs = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        for seed in seeds:
+            params = dict(zip(names, values))
+            overrides = {name: value for name, value in params.items() if name != "nr_agents"}
+            if "nr_agents" in params:
+                agent_type = params.get("agent_type", base.agent_type)
+                overrides["nr_agents"] = {**base.nr_agents, agent_type: params["nr_agents"]}
+            # Jobs run in the workers of the sweep, so each of them runs its runs in sequence and headless.
+            config = dataclasses.replace(base, **overrides, seed=seed, headless=True, n_workers=1,
+                                         instrumentation=False, trace=False)
+            jobs.append(({**params, "seed": seed}, config))
+    return jobs
+
+
+def validate_jobs(jobs: list[tuple[dict, Config]]):
+    """Raises a ValueError if any job cannot run, so a sweep fails before running any job rather than midway. The
+    configs of the jobs were validated when they were expanded, so only their map corpora are left to check."""
+    checked_corpora = set()
+    for _, config in jobs:
+        if config.map_corpus is not None and (config.map_corpus, config.map_size) not in checked_corpora:
+            get_maps(config, None)
+            checked_corpora.add((config.map_corpus, config.map_size))
+
+
+def get_code_version() -> str:
+    """Returns the version of the simulation code, a hash of the sources of its modules."""
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(MODULE_DIRECTORY, "*.py"))):
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def get_corpus_fingerprint(directory: str) -> list[list]:
+    """Returns the fingerprint of the maps of a corpus, the name, size and modification time of each of them."""
+    fingerprint = []
+    for path in corpus_paths(directory):
+        stat = os.stat(path)
+        fingerprint.append([os.path.basename(path), stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def job_key(config: Config, code_version: str) -> str:
+    """
+    Returns the key of the cached results of a job, a hash of its full config, seed included, of the version of
+    the code and of the fingerprint of its map corpus, if any, so changing either of them runs the job again.
+    """
+    corpus = get_corpus_fingerprint(config.map_corpus) if config.map_corpus is not None else None
+    content = json.dumps({"version": code_version, "config": dataclasses.asdict(config), "corpus": corpus},
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def run_job(config: Config) -> list[list]:
+    """Runs every run of the job, like main with workers or batches, and returns their metrics rows."""
+    map_sequence, run_sequences = spawn_seed_sequences(config)
+    maps = get_maps(config, map_sequence)
+    if config.batch_size > 0:
+        rows = run_vectorized(maps, config, run_sequences[0])
+    else:
+        rows = (run_episode(maps[run % len(maps)], config, run_sequences[run], run)[0] for run in range(config.n_runs))
+    return [[value.item() if isinstance(value, np.generic) else value for value in row] for row in rows]
+
+
+def load_cached(cache: str, key: str) -> list[list] | None:
+    """Returns the cached metrics rows of the job with the key, None if they are not cached."""
+    path = os.path.join(cache, key + ".json")
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fp:
+        return json.load(fp)["rows"]
+
+
+def save_cached(cache: str, key: str, code_version: str, config: Config, rows: list[list]):
+    """Caches the metrics rows of a job, along with its config. Written to a temporary file first, so an
+    interrupted sweep never leaves a partial result behind."""
+    path = os.path.join(cache, key + ".json")
+    with open(path + ".tmp", "w") as fp:
+        json.dump({"version": code_version, "config": dataclasses.asdict(config), "rows": rows}, fp)
+    os.replace(path + ".tmp", path)
+
+
+def run_sweep(jobs: list[tuple[dict, Config]], cache: str, n_workers: int = 1) -> list[tuple[dict, list[list]]]:
+    """
+    Runs the jobs that are not in the cache across a pool of worker processes and caches their results as they
+    finish. Every job is validated first. Returns the parameters and metrics rows of every job, in order.
+    """
+    validate_jobs(jobs)
+    os.makedirs(cache, exist_ok=True)
+    code_version = get_code_version()
+    keys = [job_key(config, code_version) for _, config in jobs]
+    results = [load_cached(cache, key) for key in keys]
+    pending = [i for i, rows in enumerate(results) if rows is None]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} cached, {len(pending)} to run", flush=True)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = {i: executor.submit(run_job, jobs[i][1]) for i in pending}
+        for i, future in futures.items():
+            results[i] = future.result()
+            save_cached(cache, keys[i], code_version, jobs[i][1], results[i])
+            print(f"{jobs[i][0]} done", flush=True)
+    return [(params, rows) for (params, _), rows in zip(jobs, results)]
+
+
+def write_table(path: str, results: list[tuple[dict, list[list]]]):
+    """Writes the aggregated table, one line per job with its parameters, its number of runs and the mean and
+    standard deviation over its runs of every metric."""
+    names = list(results[0][0]) if len(results) > 0 else []
+    with open(path, "w") as table:
+        table.write(", ".join(names + ["Number of runs"] +
+                              [f"{metric} ({statistic})" for metric in METRICS for statistic in ("mean", "std")]) + "\n")
+        for params, rows in results:
+            values = np.array(rows, dtype=np.float64).reshape(len(rows), len(METRICS))
+            # Metrics without a value in any run, e.g. no tree planted, are nan.
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                means = np.nanmean(values, axis=0)
+                stds = np.nanstd(values, axis=0)
+            columns = [str(params[name]) for name in names] + [str(len(rows))]
+            columns += [str(statistic) for pair in zip(means, stds) for statistic in pair]
+            table.write(", ".join(columns) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the simulation over a grid of parameters and aggregates the metrics.")
+    parser.add_argument("sweep", help="Sweep file with the grid of values of each parameter and the seeds.")
+    parser.add_argument("--config", default="./config.yml", help="Path of the config file with the other parameters.")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes running the jobs, n_workers of the config file by default.")
+    parser.add_argument("--cache", default="sweep-cache", help="Directory with the cached results of the jobs.")
+    parser.add_argument("--output", default="sweep-results.csv", help="Path of the aggregated table.")
+    args = parser.parse_args()
+
+    base = Config.load(args.config)
+    with open(args.sweep, "r") as fp:
+        sweep = yaml.safe_load(fp)
+    grid = sweep.get("grid") or {}
+    fields = {field.name for field in dataclasses.fields(Config)}
+    for name, values in grid.items():
+        if name not in fields:
+            raise ValueError(f"Parameter {name} inserted in the sweep file must be one of the config file.")
+        if not isinstance(values, list) or len(values) == 0:
+            raise ValueError(f"Values of {name} inserted in the sweep file must be a non empty list.")
+    seeds = sweep.get("seeds") or [base.seed if base.seed is not None else 0]
+
+    results = run_sweep(expand_jobs(base, grid, seeds), args.cache,
+                        args.workers if args.workers is not None else base.n_workers)
+    write_table(args.output, results)
@@ -0,0 +1,288 @@
+from typing import Iterator
+import numpy as np
+from drone import Action, ACTION_OFFSETS
+from grid import Cell, TREE_CODES, cells_to_codes
+
+# Action that moves a drone by (dx, dy), indexed by [dy + 1, dx + 1].
+OFFSET_ACTIONS = np.full((3, 3), Action.STAY.value, dtype=np.int64)
+for _action, (_dx, _dy) in enumerate(ACTION_OFFSETS):
+    if _dx != 0 or _dy != 0:
+        OFFSET_ACTIONS[_dy + 1, _dx + 1] = _action
+
+# Offsets (dx, dy) of the adjacent cells.
+NEIGHBOUR_OFFSETS = np.array([(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1)])
+
+
+class VectorEnvironment:
+    """
+    Steps a batch of independent episodes at once with array operations. Each episode has its own map and drones,
+    stored as stacked arrays: the grid codes, the drone positions, batteries, seeds and metrics.
+    Finished episodes are reset automatically and their metrics rows are kept in finished_episodes.
+
+    Follows the rules of Environment.step for Random and Greedy agents, except that all drones act on the state at
+    the beginning of the step: the type of a planted tree only looks at the trees planted in previous steps.
+    """
+
+    def __init__(self, grids: np.ndarray, n_drones: int, max_number_of_seeds: int, max_battery_available: int,
+                 rng: np.random.Generator = None):
+        self.initial_grids = np.stack([cells_to_codes(grid) for grid in grids])
+        self.batch_size, self.height, self.width = self.initial_grids.shape
+        self.n_drones = n_drones
+        self.max_number_of_seeds = max_number_of_seeds
+        self.max_battery_available = max_battery_available
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.charging_stations = np.array([self.find_charging_station(grid) for grid in self.initial_grids])
+        self.initial_fertile_land = self.initial_grids == Cell.FERTILE_LAND.value
+        self.initial_number_of_plantable_squares = np.count_nonzero(self.initial_fertile_land, axis=(1, 2))
+
+        shape = (self.batch_size, self.n_drones)
+        self.grids = np.copy(self.initial_grids)
+        self.positions = np.zeros(shape + (2,), dtype=np.int64)
+        self.battery = np.zeros(shape, dtype=np.int64)
+        self.seeds = np.zeros(shape + (3,), dtype=np.int64)
+        self.dead = np.zeros(shape, dtype=bool)
+        self.total_distance = np.zeros(shape, dtype=np.int64)
+        self.distance_between_fertile_lands = np.zeros(shape, dtype=np.int64)
+        self.distance_needed_to_identify_fertile_land_sum = np.zeros(shape, dtype=np.int64)
+        self.distance_needed_to_identify_fertile_land_count = np.zeros(shape, dtype=np.int64)
+        self.energy_used_before_planted_tree = np.zeros(shape, dtype=np.int64)
+        self.energy_per_planted_tree_sum = np.zeros(shape, dtype=np.int64)
+        self.energy_per_planted_tree_count = np.zeros(shape, dtype=np.int64)
+        self.number_of_plantable_squares = np.zeros(self.batch_size, dtype=np.int64)
+        self.number_of_planted_squares = np.zeros(self.batch_size, dtype=np.int64)
+        self.timesteps = np.zeros(self.batch_size, dtype=np.int64)
+        self.finished_episodes = []
+
+        self.reset(np.ones(self.batch_size, dtype=bool))
+
+    @staticmethod
+    def find_charging_station(grid: np.ndarray) -> tuple[int, int]:
+        """Returns the (x, y) position of the charging station, the first in a column by column scan."""
+        ys, xs = np.nonzero(grid == Cell.CHARGING_STATION.value)
+        first = np.lexsort((ys, xs))[0]
+        return xs[first], ys[first]
+
+    def reset(self, episodes: np.ndarray) -> None:
+        """Resets the maps and drones of the episodes in the mask. Drones start in random locations."""
+        n_episodes = np.count_nonzero(episodes)
+        self.grids[episodes] = self.initial_grids[episodes]
+        self.positions[episodes, :, 0] = self.rng.integers(self.width, size=(n_episodes, self.n_drones))
+        self.positions[episodes, :, 1] = self.rng.integers(self.height, size=(n_episodes, self.n_drones))
+        self.battery[episodes] = self.max_battery_available
+        self.seeds[episodes] = self.max_number_of_seeds
+        self.dead[episodes] = False
+        for metric in (self.total_distance, self.distance_between_fertile_lands,
+                       self.distance_needed_to_identify_fertile_land_sum,
+                       self.distance_needed_to_identify_fertile_land_count, self.energy_used_before_planted_tree,
+                       self.energy_per_planted_tree_sum, self.energy_per_planted_tree_count):
+            metric[episodes] = 0
+        self.number_of_plantable_squares[episodes] = self.initial_number_of_plantable_squares[episodes]
+        self.number_of_planted_squares[episodes] = 0
+        self.timesteps[episodes] = 0
+
+    def step(self, actions: np.ndarray) -> np.ndarray:
+        """
+        Performs a step in every episode with the (batch size, number of drones) action values.
+        Returns the mask of the episodes that finished, which were already reset.
+        """
+        # Unless the drone has energy, it cant do actions.
+        active = self.battery != 0
+        self.dead |= ~active
+
+        self.plant(active & (actions == Action.PLANT.value))
+        blocked = self.charge(active & (actions == Action.CHARGE.value))
+
+        # Moves that would leave the map keep the drone in place.
+        targets = self.positions + ACTION_OFFSETS[actions]
+        inside = (targets[..., 0] >= 0) & (targets[..., 0] < self.width) & \
+                 (targets[..., 1] >= 0) & (targets[..., 1] < self.height)
+        self.positions = np.where((active & inside)[..., None], targets, self.positions)
+
+        self.update_metrics(active & ~blocked)
+        self.timesteps += 1
+
+        # All the initial fertile land squares are planted with trees or all the drones are dead.
+        done = (self.number_of_plantable_squares == 0) | self.dead.all(axis=1)
+        if done.any():
+            self.finish(done)
+        return done
+
+    def plant(self, planting: np.ndarray) -> None:
+        """Drones plant the fertile land where they are located, with the tree most common around it."""
+        episodes, drones = np.nonzero(planting)
+        xs = self.positions[episodes, drones, 0]
+        ys = self.positions[episodes, drones, 1]
+        fertile = self.grids[episodes, ys, xs] == Cell.FERTILE_LAND.value
+        episodes, drones, xs, ys = episodes[fertile], drones[fertile], xs[fertile], ys[fertile]
+
+        # Counts the adjacent trees of each type, cells outside the map count as no tree.
+        padded_grids = np.pad(self.grids, ((0, 0), (1, 1), (1, 1)), constant_values=Cell.UNKNOWN.value)
+        adjacent = padded_grids[episodes[:, None], ys[:, None] + 1 + NEIGHBOUR_OFFSETS[:, 1],
+                                xs[:, None] + 1 + NEIGHBOUR_OFFSETS[:, 0]]
+        tree_counts = (adjacent[:, :, None] == TREE_CODES).sum(axis=1)
+
+        # Ties between the most common trees are broken randomly.
+        scores = self.rng.random(tree_counts.shape)
+        scores[tree_counts != tree_counts.max(axis=1, keepdims=True)] = -1
+        trees = np.argmax(scores, axis=1)
+
+        has_seeds = self.seeds[episodes, drones, trees] > 0
+        episodes, drones, xs, ys, trees = episodes[has_seeds], drones[has_seeds], xs[has_seeds], ys[has_seeds], \
+            trees[has_seeds]
+
+        # Only the first drone to plant a square does it.
+        _, first = np.unique((episodes * self.height + ys) * self.width + xs, return_index=True)
+        episodes, drones, xs, ys, trees = episodes[first], drones[first], xs[first], ys[first], trees[first]
+
+        self.seeds[episodes, drones, trees] -= 1
+        self.grids[episodes, ys, xs] = TREE_CODES[trees]
+        self.energy_per_planted_tree_sum[episodes, drones] += self.energy_used_before_planted_tree[episodes, drones]
+        self.energy_per_planted_tree_count[episodes, drones] += 1
+        self.energy_used_before_planted_tree[episodes, drones] = 0
+        np.subtract.at(self.number_of_plantable_squares, episodes, 1)
+        np.add.at(self.number_of_planted_squares, episodes, 1)
+
+    def charge(self, charging: np.ndarray) -> np.ndarray:
+        """
+        Charges the drones at the charging station. Only the first drone of each episode that tries to charge gets
+        the charging station, the others are blocked for the step. Returns the mask of the blocked drones.
+        """
+        first = charging & (np.cumsum(charging, axis=1) == 1)
+        at_charging_station = (self.positions == self.charging_stations[:, None, :]).all(axis=2)
+        charged = first & at_charging_station
+        self.battery[charged] = self.max_battery_available
+        self.seeds[charged] = self.max_number_of_seeds
+        return charging & ~first
+
+    def update_metrics(self, updated: np.ndarray) -> None:
+        """Updates drones' metrics."""
+        self.battery -= updated
+        self.total_distance += updated
+        self.distance_between_fertile_lands += updated
+        self.energy_used_before_planted_tree += updated
+
+        episodes = np.arange(self.batch_size)[:, None]
+        on_fertile_land = updated & (self.grids[episodes, self.positions[..., 1], self.positions[..., 0]] ==
+                                     Cell.FERTILE_LAND.value)
+        self.distance_needed_to_identify_fertile_land_sum += np.where(on_fertile_land,
+                                                                      self.distance_between_fertile_lands, 0)
+        self.distance_needed_to_identify_fertile_land_count += on_fertile_land
+        self.distance_between_fertile_lands[on_fertile_land] = 0
+
+    def finish(self, done: np.ndarray) -> None:
+        """Keeps the metrics rows of the finished episodes and resets them."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_energy = self.energy_per_planted_tree_sum / self.energy_per_planted_tree_count
+            avg_distance = self.distance_needed_to_identify_fertile_land_sum / \
+                self.distance_needed_to_identify_fertile_land_count
+
+        for episode in np.flatnonzero(done):
+            energies = avg_energy[episode][self.energy_per_planted_tree_count[episode] > 0]
+            distances = avg_distance[episode][self.distance_needed_to_identify_fertile_land_count[episode] > 0]
+            self.finished_episodes.append((
+                np.mean(energies) if len(energies) > 0 else np.nan,
+                np.mean(distances) if len(distances) > 0 else np.nan,
+                self.number_of_planted_squares[episode] / self.initial_number_of_plantable_squares[episode],
+                np.count_nonzero(self.dead[episode]),
+                np.mean(self.total_distance[episode]),
+                self.timesteps[episode],
+            ))
+        self.reset(done)
+
+    def episodes(self, policy, n_episodes: int) -> Iterator[tuple]:
+        """Steps all the episodes with the policy until n_episodes finished, yielding their metrics rows as they finish."""
+        n_yielded = 0
+        while n_yielded < n_episodes:
+            policy.observe(self)
+            done = self.step(policy.act(self))
+            policy.reset(done)
+            while n_yielded < min(len(self.finished_episodes), n_episodes):
+                yield self.finished_episodes[n_yielded]
+                n_yielded += 1
+
+    def run(self, policy, n_episodes: int) -> list[tuple]:
+        """Steps all the episodes with the policy until n_episodes finished and returns their metrics rows."""
+        return list(self.episodes(policy, n_episodes))
+
+
+class BatchedRandomPolicy:
+    """Batched RandomAgent, that randomly chooses an action for every drone at each timestep."""
+
+    def __init__(self, env: VectorEnvironment):
+        self.rng = env.rng
+
+    def observe(self, env: VectorEnvironment) -> None:
+        pass
+
+    def act(self, env: VectorEnvironment) -> np.ndarray:
+        return self.rng.integers(len(Action), size=(env.batch_size, env.n_drones))
+
+    def reset(self, episodes: np.ndarray) -> None:
+        pass
+
+
+class BatchedGreedyPolicy:
+    """
+    Batched GreedyAgent. Every drone keeps its own map of what it has seen, goes to the nearest known plantable
+    square (or explores the nearest unknown cell) while it has enough energy to come back, and goes to the charging
+    station when it runs out of seeds or energy. Drones fly over every cell, so distances are Chebyshev distances.
+    """
+
+    def __init__(self, env: VectorEnvironment):
+        self.maps = np.empty((env.batch_size, env.n_drones, env.height, env.width), dtype=np.uint8)
+        self.charging_stations = env.charging_stations
+        self.reset(np.ones(env.batch_size, dtype=bool))
+
+    def reset(self, episodes: np.ndarray) -> None:
+        """Every drone starts without knowing the map, except for the charging station."""
+        self.maps[episodes] = Cell.UNKNOWN.value
+        xs, ys = self.charging_stations[episodes, 0], self.charging_stations[episodes, 1]
+        self.maps[np.flatnonzero(episodes), :, ys, xs] = Cell.CHARGING_STATION.value
+
+    def observe(self, env: VectorEnvironment) -> None:
+        """Every drone sees the cell where it is located and the adjacent cells."""
+        episodes = np.arange(env.batch_size)[:, None]
+        drones = np.arange(env.n_drones)[None, :]
+        for dx, dy in np.vstack([[(0, 0)], NEIGHBOUR_OFFSETS]):
+            xs = env.positions[..., 0] + dx
+            ys = env.positions[..., 1] + dy
+            inside = (xs >= 0) & (xs < env.width) & (ys >= 0) & (ys < env.height)
+            xs, ys = np.clip(xs, 0, env.width - 1), np.clip(ys, 0, env.height - 1)
+            self.maps[episodes, drones, ys, xs] = np.where(inside, env.grids[episodes, ys, xs],
+                                                           self.maps[episodes, drones, ys, xs])
+
+    def act(self, env: VectorEnvironment) -> np.ndarray:
+        xs, ys = env.positions[..., 0], env.positions[..., 1]
+        station_xs, station_ys = self.charging_stations[:, None, 0], self.charging_stations[:, None, 1]
+        path_size_to_cs = np.maximum(np.abs(station_xs - xs), np.abs(station_ys - ys)) + 1
+
+        # Nearest known plantable square, or nearest unknown cell when none is known.
+        fertile_land = self.maps == Cell.FERTILE_LAND.value
+        exploring = ~fertile_land.any(axis=(2, 3))
+        targets = np.where(exploring[..., None, None], self.maps == Cell.UNKNOWN.value, fertile_land)
+        has_target = targets.any(axis=(2, 3))
+        distances = np.maximum(np.abs(np.arange(env.width) - xs[..., None, None]),
+                               np.abs(np.arange(env.height)[:, None] - ys[..., None, None]))
+        distances = np.where(targets, distances, np.iinfo(np.int64).max)
+        nearest = distances.reshape(env.batch_size, env.n_drones, -1).argmin(axis=2)
+        target_ys, target_xs = np.divmod(nearest, env.width)
+        target_cost = np.maximum(np.abs(target_xs - xs), np.abs(target_ys - ys)) + 1
+        target_cost_to_cs = np.maximum(np.abs(station_xs - target_xs), np.abs(station_ys - target_ys)) + 1
+        has_enough_energy = env.battery > target_cost + target_cost_to_cs
+
+        go_to_target = has_target & has_enough_energy & ~(env.seeds == 0).any(axis=2) & \
+            (path_size_to_cs + 1 != env.battery)
+
+        to_target = np.where(target_cost == 1, Action.PLANT.value,
+                             OFFSET_ACTIONS[np.sign(target_ys - ys) + 1, np.sign(target_xs - xs) + 1])
+        to_charging_station = np.where(path_size_to_cs == 1, Action.CHARGE.value,
+                                       OFFSET_ACTIONS[np.sign(station_ys - ys) + 1, np.sign(station_xs - xs) + 1])
+        return np.where(go_to_target, to_target, to_charging_station)
+
+
+# Batched policy of each of the BATCHED_AGENT_TYPES of the config.
+BATCHED_POLICIES = {
+    "RandomAgent": BatchedRandomPolicy,
+    "GreedyAgent": BatchedGreedyPolicy,
+}